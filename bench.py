@@ -0,0 +1,202 @@
+import os, sys, json, math, subprocess
+from timeit import default_timer as clock
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+import pygame
+from pygame.locals import *
+import test1
+
+FRAMES = 600
+
+####################
+####    INPUT
+####################
+def scriptedInput(frames):
+    #Runs right for two beats, left for one, hops every 17 frames and
+    #fires at the upper right corner every second
+    for f in range(frames):
+        keys = [K_d]
+        if (f//30)%3 == 2:
+            keys = [K_a]
+        if f%17 < 5:
+            keys.append(K_w)
+        yield test1.InputState(keys, (700,100), (f%40 == 0,0,0))
+
+def recordedInput(path, frames):
+    #A binary recording from ELSEWHERE_RECORD, or a JSON list of
+    #[keys, [mx,my], [b1,b2,b3]], looped to fill the run
+    if path.endswith('.inp'):
+        records = list(test1.readInputRecording(path))
+    else:
+        records = [test1.InputState(keys, pos, buttons) for keys, pos, buttons in json.load(open(path))]
+    for f in range(frames):
+        yield records[f % len(records)]
+
+####################
+####    STRESS VARIANTS
+####################
+def blanks(maptxt):
+    for y, row in enumerate(maptxt):
+        for x, col in enumerate(row):
+            if col == ' ':
+                yield x, y
+
+def setTile(maptxt, x, y, tile):
+    row = maptxt[y]
+    maptxt[y] = row[:x] + tile + row[x+1:]
+
+def manyTiles(maptxt, enemytxt):
+    maptxt = list(maptxt)
+    for x, y in list(blanks(maptxt)):
+        if (x+y)%2 == 0:
+            setTile(maptxt, x, y, '1')
+    return maptxt, enemytxt
+
+def manySaws(maptxt, enemytxt):
+    maptxt = list(maptxt)
+    enemytxt = list(enemytxt)
+    for x, y in list(blanks(maptxt)):
+        if x%2 == 0 and y%2 == 0:
+            setTile(maptxt, x, y, 'V')
+            enemytxt.append((40,40))
+    return maptxt, enemytxt
+
+def manySwitches(maptxt, enemytxt):
+    maptxt = list(maptxt)
+    for x, y in list(blanks(maptxt)):
+        if x%3 == 0 and y%2 == 0:
+            setTile(maptxt, x, y, 'M')
+    return maptxt, enemytxt
+
+VARIANTS = {'plain': None,
+            'tiles': manyTiles,
+            'saws': manySaws,
+            'switches': manySwitches}
+
+####################
+####    TIMING
+####################
+class Timings(object):
+    def __init__(self):
+        self.samples = {}
+
+    def add(self, name, seconds):
+        self.samples.setdefault(name, []).append(seconds*1000.0)
+
+    def wrap(self, obj, attr, name):
+        #Times one bound method on one instance, leaving the class alone
+        method = getattr(obj, attr)
+        def timed(*args, **kwargs):
+            start = clock()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.add(name, clock() - start)
+        setattr(obj, attr, timed)
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    k = (len(values)-1) * p / 100.0
+    lo = int(math.floor(k))
+    hi = min(lo+1, len(values)-1)
+    return values[lo] + (values[hi]-values[lo])*(k-lo)
+
+def summarize(values):
+    return {'mean': round(sum(values)/max(len(values),1), 4),
+            'p50': round(percentile(values, 50), 4),
+            'p90': round(percentile(values, 90), 4),
+            'p99': round(percentile(values, 99), 4),
+            'max': round(max(values or [0.0]), 4)}
+
+def newLevel(name, variant, timings):
+    maptxt, enemytxt = test1.loadCompiledLevel(name)
+    if VARIANTS[variant] is not None:
+        maptxt, enemytxt = VARIANTS[variant](maptxt, enemytxt)
+    n = int(name) if name.isdigit() else name
+    level = test1.Level(n, maptxt, enemytxt)
+    level.start()
+    timings.wrap(level.map, 'update', 'map.update')
+    timings.wrap(level.player, 'update', 'player.update')
+    timings.wrap(level.map, 'displaybg', 'map.displaybg')
+    timings.wrap(level.map, 'drawTiles', 'map.drawTiles')
+    timings.wrap(level.player, 'draw', 'player.draw')
+    return level
+
+def benchLevel(name, variant, frames, inputs):
+    timings = Timings()
+    level = newLevel(name, variant, timings)
+    restarts = 0
+    frame_ms = []
+    for inp in inputs:
+        start = clock()
+        #Restarted in place as the game does, so no rebuild lands in a frame
+        if level.done():
+            level.restart()
+            restarts += 1
+        level.update(inp)
+        level.draw()
+        t = clock()
+        test1.updateDisplay()
+        timings.add('display.update', clock() - t)
+        frame_ms.append((clock() - start)*1000.0)
+    result = {'frames': len(frame_ms),
+              'restarts': restarts,
+              'tiles': len(level.map.platforms),
+              'saws': len(level.map.enemies),
+              'switches': len(level.map.switches),
+              'frame_ms': summarize(frame_ms),
+              'subsystems': {}}
+    for key, values in timings.samples.items():
+        result['subsystems'][key] = summarize(values)
+    return result
+
+####################
+####    MAIN
+####################
+def levelNames():
+    names = [f[:-4] for f in os.listdir('map') if f.endswith('.txt')]
+    return sorted(names, key=lambda n: (not n.isdigit(), n.isdigit() and int(n), n))
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    import optparse
+    parser = optparse.OptionParser(usage='%prog [options] [level ...]')
+    parser.add_option('-f', '--frames', type='int', default=FRAMES)
+    parser.add_option('-v', '--variant', action='append', choices=sorted(VARIANTS.keys()),
+                      help='plain, tiles, saws or switches (repeatable, default all)')
+    parser.add_option('-i', '--input', help='recorded input, a .inp recording or a JSON list of frames')
+    parser.add_option('-o', '--output', help='write JSON here instead of stdout')
+    opts, names = parser.parse_args()
+
+    test1.initDisplay()
+    names = names or levelNames()
+    variants = opts.variant or sorted(VARIANTS.keys())
+
+    report = {'revision': revision(), 'frames': opts.frames, 'levels': {}}
+    for name in names:
+        for variant in variants:
+            if opts.input:
+                inputs = recordedInput(opts.input, opts.frames)
+            else:
+                inputs = scriptedInput(opts.frames)
+            report['levels']['%s/%s' % (name, variant)] = benchLevel(name, variant, opts.frames, inputs)
+            sys.stderr.write('%s/%s done\n' % (name, variant))
+
+    out = sys.stdout
+    if opts.output:
+        out = open(opts.output, 'w')
+    json.dump(report, out, indent=1, sort_keys=True)
+    out.write('\n')
+
+if __name__ == '__main__':
+    main()
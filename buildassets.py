@@ -0,0 +1,31 @@
+import sys, os
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+import test1
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else test1.ASSET_PACK
+    test1.initHeadless()
+    #Loaded fresh from the PNGs, not from the pack being replaced
+    test1.ASSETS.pack = None
+    test1.ASSETS.clear()
+    #Whatever the menu and every level load is what gets packed
+    test1.Menu()
+    failed = 0
+    for name in sorted([f[:-4] for f in os.listdir('map') if f.endswith('.txt')]):
+        try:
+            test1.Level(int(name) if name.isdigit() else name)
+        except (test1.LevelError, IOError), e:
+            print 'error:', e
+            failed += 1
+    test1.writeAssetPack(test1.ASSETS, path)
+    print '%d images, %d sheets -> %s (%d bytes)' % (len(test1.ASSETS.images),
+        len(test1.ASSETS.sprites), path, os.path.getsize(path))
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,20 @@
+import sys, os
+import test1
+
+def main():
+    names = sys.argv[1:]
+    if not names:
+        names = sorted([f[:-4] for f in os.listdir('map') if f.endswith('.txt')])
+    failed = 0
+    for name in names:
+        try:
+            path = test1.compileLevel(name)
+            print '%s -> %s' % (name, path)
+        except (test1.LevelError, IOError), e:
+            print 'error:', e
+            failed += 1
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,342 @@
+import os, sys, time, random, hashlib
+import multiprocessing
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+import test1
+
+WIDTH = 20
+HEIGHT = 15
+OUTPUT_DIR = 'map/endless'
+#Accepted levels per pack file, and candidates per worker task
+BATCH = 500
+TASK = 200
+#In tiles, from the player physics: a held jump clears one tile and a
+#running one about four across
+JUMP_UP = 1
+JUMP_ACROSS = 4
+MIN_DISTANCE = 8
+#In pixels, from Enemy: the rect that patrols, how far it moves a tick and
+#how far the drawn blade reaches past either end of it
+SAW_WIDTH = 60
+SAW_SPEED = 3
+SAW_OVERHANG = 15
+
+SOLID = '0123456789SM'
+
+####################
+####    CANDIDATES
+####################
+def setTile(grid, x, y, tile):
+    row = grid[y]
+    grid[y] = row[:x] + tile + row[x+1:]
+
+def emptyCell(rng, grid, standing=False):
+    for attempt in range(50):
+        x = rng.randint(1, WIDTH-2)
+        y = rng.randint(1, HEIGHT-2)
+        if grid[y][x] != ' ':
+            continue
+        if standing and grid[y+1][x] not in '0123456789':
+            continue
+        return x, y
+    return None
+
+def patrol(grid, x, y):
+    #Patrol distances that keep a saw on the run of tiles below it
+    left = right = 0
+    while x-left-1 > 0 and grid[y+1][x-left-1] in '0123456789' and grid[y][x-left-1] == ' ':
+        left += 1
+    while x+right+1 < WIDTH-1 and grid[y+1][x+right+1] in '0123456789' and grid[y][x+right+1] == ' ':
+        right += 1
+    return left*test1.TILESIZE, right*test1.TILESIZE
+
+def candidate(rng):
+    grid = ['4'*WIDTH] + ['3' + ' '*(WIDTH-2) + '3' for y in range(HEIGHT-2)] + ['1'*WIDTH]
+    #A pit or two in the floor, then floating runs of tiles
+    for i in range(rng.randint(0, 2)):
+        x = rng.randint(2, WIDTH-6)
+        for dx in range(rng.randint(2, 4)):
+            setTile(grid, x+dx, HEIGHT-1, ' ')
+    for i in range(rng.randint(3, 9)):
+        x = rng.randint(1, WIDTH-3)
+        y = rng.randint(3, HEIGHT-3)
+        tile = rng.choice('1112')
+        for dx in range(min(rng.randint(2, 8), WIDTH-1-x)):
+            setTile(grid, x+dx, y, tile)
+    for tile, count in (('Q', 1), ('E', 1), ('S', rng.randint(0, 3)), ('M', rng.randint(0, 1))):
+        for i in range(count):
+            cell = emptyCell(rng, grid, tile in 'QE')
+            if cell is None:
+                return None
+            setTile(grid, cell[0], cell[1], tile)
+    enemytxt = []
+    for i in range(rng.randint(0, 3)):
+        cell = emptyCell(rng, grid, True)
+        if cell is None:
+            break
+        setTile(grid, cell[0], cell[1], 'V')
+    #Patrols are read back in the order populate() meets the saws
+    for y, row in enumerate(grid):
+        for x, col in enumerate(row):
+            if col == 'V':
+                enemytxt.append(patrol(grid, x, y))
+    return grid, enemytxt
+
+def candidates(seed):
+    rng = random.Random(seed)
+    while True:
+        level = candidate(rng)
+        if level is not None:
+            yield level
+
+####################
+####    CHECKS
+####################
+def contentHash(maptxt, enemytxt):
+    #Mirror images play the same, so both hash to the smaller digest
+    mirrored = [row[::-1] for row in maptxt]
+    flipped = [(right, left) for left, right in enemytxt]
+    saws = [(y, len(row)-1-x) for y, row in enumerate(maptxt) for x, col in enumerate(row) if col == 'V']
+    flipped = [params for cell, params in sorted(zip(saws, flipped))]
+    return min(hashlib.sha1(test1.packLevel(maptxt, enemytxt)).digest(),
+               hashlib.sha1(test1.packLevel(mirrored, flipped)).digest())
+
+def find(maptxt, tile):
+    return [(x, y) for y, row in enumerate(maptxt) for x, col in enumerate(row) if col == tile]
+
+def tileAt(maptxt, x, y):
+    #Rows may stop short; past their end is open air
+    if y < 0 or y >= len(maptxt) or x < 0:
+        return None
+    row = maptxt[y]
+    return row[x] if x < len(row) else ' '
+
+def passable(maptxt, x, y, danger=()):
+    tile = tileAt(maptxt, x, y)
+    return tile is not None and tile not in SOLID + 'V' and (x, y) not in danger
+
+def solid(maptxt, x, y):
+    tile = tileAt(maptxt, x, y)
+    return tile is not None and tile in SOLID
+
+def sawCells(maptxt, enemytxt):
+    #Every cell a saw's blade can sweep along its row, patrol and all
+    size = test1.TILESIZE
+    cells = set()
+    for (col, row), (tile, limits) in test1.levelSpawns(maptxt, enemytxt).items():
+        if tile != 'V':
+            continue
+        left, right = limits
+        x = size/2 + col*size
+        start = x - SAW_WIDTH/2
+        lo = min(start, x - left - SAW_SPEED) - SAW_OVERHANG
+        hi = max(start, x + right + SAW_SPEED) + SAW_WIDTH + SAW_OVERHANG
+        for cx in range(lo//size, (hi-1)//size + 1):
+            cells.add((cx, row))
+    return cells
+
+def fall(maptxt, x, y, falls, danger=()):
+    #Where a player let go at (x,y) can land, drifting up to a tile
+    #sideways for every tile fallen, and every cell passed on the way.
+    #Falls off the bottom or through a saw's reach land nowhere
+    if (x, y) in falls:
+        return falls[x, y]
+    landings, cells = [], set()
+    row = [x] if passable(maptxt, x, y, danger) else []
+    depth = y
+    while row:
+        below = []
+        for cx in row:
+            cells.add((cx, depth))
+            if solid(maptxt, cx, depth+1):
+                landings.append((cx, depth))
+            for dx in (-1, 0, 1):
+                if (passable(maptxt, cx+dx, depth, danger) and passable(maptxt, cx+dx, depth+1, danger)
+                        and cx+dx not in below):
+                    below.append(cx+dx)
+        row = below
+        depth += 1
+    falls[x, y] = landings, cells
+    return landings, cells
+
+def inSight(maptxt, (x0, y0), (x1, y1)):
+    steps = max(abs(x1-x0), abs(y1-y0))*2
+    for i in range(1, steps):
+        x = int(round(x0 + (x1-x0)*i/float(steps)))
+        y = int(round(y0 + (y1-y0)*i/float(steps)))
+        if (x, y) != (x1, y1) and solid(maptxt, x, y):
+            return False
+    return True
+
+def plausible(maptxt, enemytxt):
+    #Cheap structural check on the tile grid: walks, jumps, falls and
+    #swaps over whole tiles. Playable levels it cannot route are dropped
+    #too, which only costs candidates; solve.py is the real test
+    for tile in 'QE':
+        if len(find(maptxt, tile)) != 1:
+            return False
+    start, exit = find(maptxt, 'Q')[0], find(maptxt, 'E')[0]
+    if abs(start[0]-exit[0]) + abs(start[1]-exit[1]) < MIN_DISTANCE:
+        return False
+    #No saw may reach the entrance or the cells either side of it, and no
+    #route may stand in or fall through a saw's reach
+    danger = sawCells(maptxt, enemytxt)
+    for dx in (-1, 0, 1):
+        if (start[0]+dx, start[1]) in danger:
+            return False
+    switches = find(maptxt, 'S') + find(maptxt, 'M')
+    falls = {}
+    todo = list(fall(maptxt, start[0], start[1], falls, danger)[0])
+    stood = set(todo)
+    swapped = False
+    while todo:
+        x, y = todo.pop()
+        starts = []
+        #Once a switch can be swapped it may be left anywhere the player
+        #stood, to be climbed on; each switch makes the pile one higher
+        ground = [k for k in range(1, len(switches)+1) if solid(maptxt, x, y+k)]
+        if swapped and ground and passable(maptxt, x, y-1, danger) and (x, y-1) not in stood:
+            stood.add((x, y-1))
+            todo.append((x, y-1))
+        if passable(maptxt, x, y-1, danger):
+            for dx in range(-JUMP_ACROSS, JUMP_ACROSS+1):
+                for dy in range(-JUMP_UP, 1):
+                    if passable(maptxt, x+dx, y+dy, danger) and passable(maptxt, x+dx, y+dy-1, danger):
+                        starts.append((x+dx, y+dy))
+        #A swap drops the player where the switch was
+        for sx, sy in switches:
+            if inSight(maptxt, (x, y), (sx, sy)):
+                if not swapped:
+                    swapped = True
+                    todo.extend(stood)
+                if solid(maptxt, sx, sy+1):
+                    if (sx, sy) not in stood:
+                        stood.add((sx, sy))
+                        todo.append((sx, sy))
+                else:
+                    starts.append((sx, sy+1))
+        for start in starts:
+            landings, cells = fall(maptxt, start[0], start[1], falls, danger)
+            if exit in cells:
+                return True
+            for landing in landings:
+                if landing not in stood:
+                    stood.add(landing)
+                    todo.append(landing)
+    return exit in stood
+
+def generateBatch((seed, count)):
+    #Runs in a worker: returns only the candidates that pass, already packed
+    accepted = []
+    for i, (maptxt, enemytxt) in enumerate(candidates(seed)):
+        if i >= count:
+            break
+        if plausible(maptxt, enemytxt):
+            accepted.append((contentHash(maptxt, enemytxt), test1.packLevel(maptxt, enemytxt)))
+    return count, accepted
+
+####################
+####    OUTPUT
+####################
+class HashCache(object):
+    def __init__(self, path):
+        self.path = path
+        self.seen = set()
+        if os.path.exists(path):
+            data = open(path, 'rb').read()
+            for i in range(0, len(data), 20):
+                self.seen.add(data[i:i+20])
+        self.pending = []
+
+    def __str__(self):
+        return "Digests of every level already written."
+
+    def add(self, digest):
+        if digest in self.seen:
+            return False
+        self.seen.add(digest)
+        self.pending.append(digest)
+        return True
+
+    def flush(self):
+        out = open(self.path, 'ab')
+        out.write(''.join(self.pending))
+        out.close()
+        self.pending = []
+
+def writePack(outdir, levels):
+    n = len([f for f in os.listdir(outdir) if f.endswith('.lvp')])
+    path = os.path.join(outdir, 'pack%05d.lvp' % n)
+    #Written aside and renamed like compiled levels
+    out = open(path + '.tmp', 'wb')
+    out.write(''.join(levels))
+    out.close()
+    os.rename(path + '.tmp', path)
+    return path
+
+def handWritten():
+    names = [f[:-4] for f in os.listdir('map') if f.endswith('.txt')]
+    for name in names:
+        try:
+            yield test1.loadLevelText(name)
+        except (test1.LevelError, IOError):
+            pass
+
+####################
+####    MAIN
+####################
+def main():
+    import optparse
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--count', type='int', default=1000, help='levels to write, 0 for no limit')
+    parser.add_option('-j', '--jobs', type='int', default=multiprocessing.cpu_count())
+    parser.add_option('-s', '--seed', type='int', default=None)
+    parser.add_option('-o', '--output', default=OUTPUT_DIR)
+    opts, args = parser.parse_args()
+
+    if not os.path.isdir(opts.output):
+        os.makedirs(opts.output)
+    cache = HashCache(os.path.join(opts.output, 'hashes'))
+    for maptxt, enemytxt in handWritten():
+        cache.seen.add(contentHash(maptxt, enemytxt))
+    seed = opts.seed
+    if seed is None:
+        seed = int(time.time()*1000)
+
+    pool = multiprocessing.Pool(max(opts.jobs, 1))
+    start = time.time()
+    tried = written = dupes = 0
+    batch = []
+    while not opts.count or written + len(batch) < opts.count:
+        #Handed out a wave at a time, so an endless run never queues more
+        #than a few tasks ahead of the writer
+        tasks = [(seed+i, TASK) for i in range(2*max(opts.jobs, 1))]
+        seed += len(tasks)
+        for count, accepted in pool.imap_unordered(generateBatch, tasks):
+            tried += count
+            for digest, data in accepted:
+                if opts.count and written + len(batch) >= opts.count:
+                    break
+                if not cache.add(digest):
+                    dupes += 1
+                    continue
+                batch.append(data)
+                if len(batch) >= BATCH:
+                    writePack(opts.output, batch)
+                    cache.flush()
+                    written += len(batch)
+                    batch = []
+    if batch:
+        writePack(opts.output, batch)
+        cache.flush()
+        written += len(batch)
+    pool.close()
+    seconds = time.time() - start
+    print '%d levels from %d candidates (%d duplicates) in %.1fs, %d per minute' % (
+        written, tried, dupes, seconds, written*60/max(seconds, 0.001))
+
+if __name__ == '__main__':
+    main()
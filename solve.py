@@ -0,0 +1,289 @@
+import os, sys, json, time, heapq
+import multiprocessing
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+import pygame
+from pygame.locals import *
+import test1
+
+MACRO_TICKS = 8
+#Moves without a jump run on past MACRO_TICKS until the player lands
+MAX_MACRO_TICKS = 48
+MAX_STATES = 20000
+#A level still unsolved after this long fails the run
+MAX_SECONDS = 30
+SWAP_TICKS = 60
+#Pixels the player and the patrolling parts are bucketed by in the state key,
+#more coarsely while the player is in the air
+PLAYER_GRAIN = 12
+AIR_GRAIN = 36
+PATROL_GRAIN = 12
+#Fastest the player covers ground, in pixels per tick, for the A* estimate;
+#it is walked around the level's walls a tile at a time
+MAX_RUN = 6
+MAX_FALL = 8
+#Above 1 the search heads for the exit more greedily, trading a guaranteed
+#shortest route for far fewer expanded states
+ESTIMATE_WEIGHT = 3
+
+#Held for a macro each; shots are added per switch at search time.
+#Walking jumps are left out, a run or leap over two macros covers them
+MOVES = [('idle', []),
+         ('left', [K_a]),
+         ('right', [K_d]),
+         ('jump', [K_w]),
+         ('run left', [K_a, K_LSHIFT]),
+         ('run right', [K_d, K_LSHIFT]),
+         ('leap left', [K_a, K_w, K_LSHIFT]),
+         ('leap right', [K_d, K_w, K_LSHIFT])]
+
+####################
+####    SEARCH
+####################
+class Search(object):
+    def __init__(self, name):
+        n = int(name) if name.isdigit() else name
+        self.level = test1.Level(n)
+        self.level.start()
+        #Fixed orders so captured states line up with restored ones
+        self.switches = sorted(self.level.map.switches, key=lambda s: s.rect.center)
+        self.enemies = sorted(self.level.map.enemies, key=lambda e: e.rect.center)
+        self.statics = [s for s in self.switches if not isinstance(s, test1.MovingSwitch)]
+        self.inputs = []
+        self.distances = self.exitDistances()
+
+    def exitDistances(self):
+        #Ticks from each open tile to the exit's at full speed, by Dijkstra
+        #over the layout; diagonals need both sides open to squeeze past
+        layout = self.level.map.layout
+        width = max([len(row) for row in layout])
+        def clear(x, y):
+            if y < 0 or y >= len(layout) or x < 0 or x >= width:
+                return False
+            return x >= len(layout[y]) or layout[y][x] not in '0123456789'
+        across, down = float(test1.TILESIZE)/MAX_RUN, float(test1.TILESIZE)/MAX_FALL
+        exit = self.level.map.exit
+        start = (exit.centerx//test1.TILESIZE, exit.centery//test1.TILESIZE)
+        distances = {start: 0.0}
+        frontier = [(0.0, start)]
+        while frontier:
+            d, (x, y) = heapq.heappop(frontier)
+            if d > distances[x, y]:
+                continue
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    if not (dx or dy) or not (clear(x+dx, y+dy) and clear(x+dx, y) and clear(x, y+dy)):
+                        continue
+                    nd = d + max(across*abs(dx), down*abs(dy))
+                    if nd < distances.get((x+dx, y+dy), nd+1):
+                        distances[x+dx, y+dy] = nd
+                        heapq.heappush(frontier, (nd, (x+dx, y+dy)))
+        return distances
+
+    def capture(self):
+        #Only taken between swaps, so the scheduler is known to be empty
+        return self.level.snapshot()
+
+    def restore(self, state):
+        #Undoes whatever the last branch left behind: a death, a swap or a shot
+        self.level.restore(state)
+
+    def key(self):
+        #Positions are bucketed, so near-identical states are expanded once
+        player = self.level.player
+        if player.jumping:
+            grain, falling = AIR_GRAIN, player.jump_speed > 0
+        else:
+            grain, falling = PLAYER_GRAIN, False
+        patrols = [(e.rect.x//PATROL_GRAIN, e.dx) for e in self.enemies]
+        for spr in self.switches:
+            if spr in self.statics:
+                patrols.append(spr.rect.center)
+            else:
+                patrols.append((spr.rect.x//PATROL_GRAIN, spr.rect.y//PATROL_GRAIN, spr.dx, spr.dy))
+        return hash((player.rect.x//grain, player.rect.y//grain,
+                     falling, player.jumping, tuple(patrols)))
+
+    def estimate(self):
+        #Ticks to the exit at full speed; swaps can beat it, so a shortcut
+        #through one may not be the shortest
+        player = self.level.player.rect
+        dx = abs(player.centerx - self.level.map.exit.centerx)
+        dy = abs(player.centery - self.level.map.exit.centery)
+        tile = (player.centerx//test1.TILESIZE, player.centery//test1.TILESIZE)
+        return max(dx/MAX_RUN, dy/MAX_FALL, self.distances.get(tile, 0))
+
+    def step(self, inp):
+        self.level.update(inp)
+        self.inputs.append(inp)
+        return not self.failed()
+
+    def failed(self):
+        return self.level.player.dying or not self.level.player_group
+
+    def won(self):
+        return self.level.done() and self.level.won()
+
+    def move(self, keys):
+        #Jumps stop in the air, to leave somewhere to shoot from
+        inp = test1.InputState(keys)
+        land = K_w not in keys
+        for i in range(MAX_MACRO_TICKS):
+            if not self.step(inp) or self.won():
+                break
+            if i+1 >= MACRO_TICKS and not (land and self.level.player.jumping):
+                break
+
+    def shoot(self, target):
+        #Fires at a switch and waits for the shot, and any swap, to finish
+        player = self.level.player
+        #The arm angle is taken from the player's top left corner but the
+        #shot leaves from the centre, so aim off by the difference
+        x = target[0] - player.rect.w/2 - self.level.camera.rect.x
+        y = target[1] - player.rect.h/2 - self.level.camera.rect.y
+        aim = (x, y)
+        inp = test1.InputState((), aim, (1,0,0))
+        swapped = False
+        for i in range(SWAP_TICKS):
+            if not self.step(inp):
+                return False
+            inp = test1.InputState((), aim)
+            swapped = swapped or player.swapping
+            if not test1.SCHEDULER.tasks and not len(player.shots):
+                break
+        #Only shots that actually swapped are worth keeping
+        return swapped and not test1.SCHEDULER.tasks and not len(player.shots)
+
+    def actions(self):
+        for name, keys in MOVES:
+            yield name, keys, None
+        for spr in self.switches:
+            yield 'shoot %d,%d' % spr.rect.center, None, spr.rect.center
+
+    def expand(self, state):
+        for name, keys, target in self.actions():
+            self.restore(state)
+            self.inputs = []
+            if target is None:
+                self.move(keys)
+                ok = not self.failed()
+            else:
+                ok = self.shoot(target)
+            if ok:
+                yield name, self.inputs, self.capture(), self.won()
+
+    def run(self, maxstates=MAX_STATES, maxseconds=MAX_SECONDS):
+        #A* over macro steps, ordered by ticks so far plus estimate()
+        deadline = time.time() + maxseconds
+        seen = set([self.key()])
+        order = 0
+        frontier = [(ESTIMATE_WEIGHT*self.estimate(), 0, order, self.capture(), None)]
+        while frontier and len(seen) < maxstates and time.time() < deadline:
+            f, ticks, i, state, path = heapq.heappop(frontier)
+            for name, inputs, child, won in self.expand(state):
+                node = (name, inputs, path)
+                if won:
+                    return unwind(node), len(seen)
+                key = self.key()
+                if key in seen:
+                    continue
+                seen.add(key)
+                order += 1
+                cost = ticks + len(inputs)
+                heapq.heappush(frontier, (cost + ESTIMATE_WEIGHT*self.estimate(), cost, order, child, node))
+        return None, len(seen)
+
+def unwind(node):
+    steps = []
+    while node is not None:
+        name, inputs, node = node
+        steps.append((name, inputs))
+    steps.reverse()
+    return steps
+
+def replay(name, steps):
+    #A fresh level fed the same inputs has to reach the exit as well
+    n = int(name) if name.isdigit() else name
+    inputs = [inp for step, stepinputs in steps for inp in stepinputs]
+    level = test1.simulateLevel(n, inputs)
+    return level.done() and level.won()
+
+def record(inp):
+    keys = [k for k in (K_a, K_d, K_w, K_LSHIFT) if inp[k]]
+    return [keys, list(inp.mouse_pos), list(inp.mouse_buttons)]
+
+def describe(steps):
+    runs = []
+    for name, inputs in steps:
+        if runs and runs[-1][0] == name:
+            runs[-1][1] += len(inputs)
+        else:
+            runs.append([name, len(inputs)])
+    return ', '.join(['%s x%d' % (name, ticks) for name, ticks in runs])
+
+####################
+####    MAIN
+####################
+def solveLevel(args):
+    name, maxstates, maxseconds = args
+    start = time.time()
+    try:
+        steps, states = Search(name).run(maxstates, maxseconds)
+    except (test1.LevelError, IOError), e:
+        return name, {'error': str(e)}
+    result = {'solved': steps is not None,
+              'states': states,
+              'seconds': round(time.time()-start, 2)}
+    if steps is not None:
+        result['ticks'] = sum([len(inputs) for step, inputs in steps])
+        result['verified'] = replay(name, steps)
+        result['solution'] = describe(steps)
+        result['inputs'] = [record(inp) for step, inputs in steps for inp in inputs]
+    return name, result
+
+def levelNames():
+    names = [f[:-4] for f in os.listdir('map') if f.endswith('.txt')]
+    return sorted(names, key=lambda n: (not n.isdigit(), n.isdigit() and int(n), n))
+
+def main():
+    import optparse
+    parser = optparse.OptionParser(usage='%prog [options] [level ...]')
+    parser.add_option('-j', '--jobs', type='int', default=multiprocessing.cpu_count())
+    parser.add_option('-m', '--max-states', type='int', default=MAX_STATES)
+    parser.add_option('-t', '--max-seconds', type='float', default=MAX_SECONDS)
+    parser.add_option('-o', '--output', help='write each solution to DIR/N.json for bench.py -i')
+    opts, names = parser.parse_args()
+    names = names or [n for n in levelNames() if n.isdigit()]
+
+    if ESTIMATE_WEIGHT > 1:
+        print 'Routes are found greedily and may not be the shortest'
+    pool = multiprocessing.Pool(max(opts.jobs, 1), test1.initHeadless)
+    failed = 0
+    args = [(n, opts.max_states, opts.max_seconds) for n in names]
+    for name, result in pool.imap_unordered(solveLevel, args):
+        if 'error' in result:
+            print '%s: error: %s' % (name, result['error'])
+            failed += 1
+        elif not result['solved']:
+            print '%s: no solution in %d states (%.2fs)' % (name, result['states'], result['seconds'])
+            failed += 1
+        else:
+            print '%s: %d ticks, %d states, %.2fs%s' % (name, result['ticks'], result['states'],
+                result['seconds'], '' if result['verified'] else ', REPLAY FAILED')
+            print '    ' + result['solution']
+            if not result['verified']:
+                failed += 1
+            if opts.output:
+                if not os.path.isdir(opts.output):
+                    os.makedirs(opts.output)
+                json.dump(result['inputs'], open(os.path.join(opts.output, name + '.json'), 'w'))
+        sys.stdout.flush()
+    pool.close()
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,22 @@
-import pygame, sys, math, random
+import pygame, sys, os, math, random, struct, mmap, time, threading, json
+from collections import OrderedDict, deque
+from timeit import default_timer
 from pygame.locals import *
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 WINDOWWIDTH = 800
 WINDOWHEIGHT = 600
 FPS = 40
 
+#Logic always steps at FPS; rendering runs up to RENDER_FPS, interpolating
+#between ticks, and skips frames (never ticks) when the loop falls behind
+RENDER_FPS = 120
+MAX_CATCHUP = 5
+MAX_FRAMESKIP = 4
+
 TOP_SIDE = 0
 BOTTOM_SIDE = 2
 LEFT_SIDE = 3
@@ -12,29 +24,523 @@ RIGHT_SIDE =1
 
 TILESIZE = 40
 
+#The world is split into CHUNKSIZE x CHUNKSIZE tile chunks. Chunks within
+#STREAM_MARGIN pixels of the camera are loaded (and their static tiles
+#composited into one surface) and dropped again once twice that far away.
+#Switches and saws more than ACTIVE_MARGIN off screen are frozen.
+PREBAKE_TILES = True
+CHUNKSIZE = 16
+CHUNK_COLORKEY = (255,0,255)
+STREAM_MARGIN = 320
+ACTIVE_MARGIN = 200
+
+#Layouts hanging off the window by up to CAMERA_SLACK pixels are played as
+#single screens, as the original levels keep some decoration off the bottom
+CAMERA_SLACK = 2*TILESIZE
+
+#Push only the changed rects to the display, unless more than
+#DIRTY_THRESHOLD of the screen changed in which case flip everything
+DIRTY_RECTS = False
+DIRTY_THRESHOLD = 0.5
+
+#Rotated arm and bullet images are cached in ROTATION_STEP degree buckets
+ROTATION_STEP = 2
+ROTATION_CACHE_SIZE = 360
+ROTATION_PREBUILD = False
+
+#Background layers back to front as (image path or fill colour, scroll speed);
+#runs of static layers are flattened and scrolling ones pre-tiled
+LEVEL_LAYERS = (((46,48,151), 0),
+                ('img/menu_cloud1.png', 1),
+                ('img/city_bg.png', 0),
+                ('img/menu_cloud2.png', 2))
+                #('img/menu_cloud3.png', 4)
+MENU_LAYERS = (('img/menu_bg.png', 0),
+               ('img/menu_cloud3.png', 4))
+
 NUMBEROFLEVELS = 17
 
 PLAY = 1
 MENU = 2
 
-def isNumber(s):
-    try:
-        float(s)
-        return True
-    except ValueError:
-        return False
-    
+#Levels are compiled from map/*.txt into LEVEL_BUILD_DIR and rebuilt
+#whenever the source text is newer
+LEVEL_BUILD_DIR = 'map/build'
+LEVEL_MAGIC = 'ELVL'
+LEVEL_VERSION = 1
+LEVEL_TILES = '0123456789QESMV '
+
+#ELSEWHERE_LEVEL picks the first level played, by number or by name for
+#scratch levels like testlevel. ELSEWHERE_WATCH=1 reloads the running
+#level in place whenever its map or enemy file is saved
+START_LEVEL = os.environ.get('ELSEWHERE_LEVEL', '15')
+START_LEVEL = int(START_LEVEL) if START_LEVEL.isdigit() else START_LEVEL
+WATCH_LEVELS = bool(os.environ.get('ELSEWHERE_WATCH'))
+WATCH_INTERVAL = 0.5
+
+#Projectiles live in a fixed-size pool per shooter and are swept against
+#the spatial grid each tick, so fast ones can't skip over a tile
+BULLET_POOL_SIZE = 256
+BULLET_SPEED = 20
+BULLET_RADIUS = 5
+#Hits are tested on masks of the drawn pixels, which reach this far past
+#the rect a sprite is indexed by
+MASK_MARGIN = 20
+
+#F3 toggles the frame profiler overlay; ELSEWHERE_PROFILE=file.csv or
+#file.jsonl streams every frame's timings to disk
+PROFILE_HOTKEY = K_F3
+PROFILE_WINDOW = 120
+PROFILE_LOG = os.environ.get('ELSEWHERE_PROFILE')
+
+#Input: physical key -> the key the game reads it as, and a directory to
+#record each level's ticks into
+KEY_BINDINGS = {}
+INPUT_MAGIC = 'EINP'
+INPUT_VERSION = 1
+INPUT_LOG = os.environ.get('ELSEWHERE_RECORD')
+
+#Effects are decoded once into AUDIO and played on a fixed channel pool;
+#a repeat within its limit (ms) is dropped. A shipped .ogg is preferred
+#over the named file.
+AUDIO_CHANNELS = 8
+SOUNDS = {'shoot': ('sound/pew.wav', 80),
+          'walk': ('sound/walk.ogg', 200)}
+MUSIC = 'sound/funkycruise.wav'
+
+#buildassets.py writes every image and sliced sheet the game loads into
+#one file of raw pixels, which surfaces are made over without a decode.
+#Pixels are stored the way a 32 bit display lays them out; any other
+#display converts them on load. Ignored when older than img/
+ASSET_PACK = 'img/build/assets.pak'
+ASSET_MAGIC = 'EAST'
+ASSET_VERSION = 1
+ASSET_MASKS = (0xff0000, 0xff00, 0xff, 0xff000000)
+ASSET_SHIFTS = (16, 8, 0, 24)
+
+#Set by initHeadless(): logic runs without a display, sound or frame cap
+HEADLESS = False
+
+def toDisplayFormat(img, colorkey=(255,255,255), convert=True):
+    #convert() needs a display mode, so headless loads keep the file format
+    if convert and pygame.display.get_surface() is not None:
+        if img.get_flags() & SRCALPHA:
+            img = img.convert_alpha()
+        else:
+            img = img.convert()
+    if colorkey is not None:
+        img.set_colorkey(colorkey, RLEACCEL)
+    return img
+
+def loadImage(filepath, colorkey=(255,255,255)):
+    return toDisplayFormat(pygame.image.load(filepath), colorkey)
+
 def loadSlicedSprites(w,h,filepath):
     images=[]
     masterImg=pygame.image.load(filepath)
-    masterImg.set_colorkey((255,255,255))
     masterw,masterh=masterImg.get_size()
+    #Slices are copied so each one gets its own RLE-encoded pixels
     for i in range(int(masterw/w)):
-        images.append(masterImg.subsurface((i*w,0,w,h)))
-    for image in images:
-        image.set_colorkey((255,255,255))
+        images.append(toDisplayFormat(masterImg.subsurface((i*w,0,w,h)).copy()))
     return images
 
+def packPixels(img):
+    #Raw pixels in the ASSET_MASKS layout; the unused byte of opaque
+    #images must be zero or colorkeys never match
+    alpha = bool(img.get_flags() & SRCALPHA)
+    data = bytearray(pygame.image.tostring(img, 'RGBA' if alpha else 'RGBX'))
+    data[0::4], data[2::4] = data[2::4], data[0::4]
+    if not alpha:
+        data[3::4] = '\0'*(len(data)/4)
+    return alpha, str(data)
+
+class AssetPack(object):
+    def __init__(self, path=ASSET_PACK):
+        self.path = path
+        self.buf = None
+        self.base = 0
+        self.entries = {}
+        if assetPackIsStale(path):
+            return
+        f = open(path, 'rb')
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        header = struct.calcsize('<4sBI')
+        magic, version, size = struct.unpack_from('<4sBI', buf, 0)
+        if magic != ASSET_MAGIC or version != ASSET_VERSION:
+            buf.close()
+            return
+        for kind, key, frames, mirrored in json.loads(buf[header:header+size]):
+            self.entries[kind, tuple([tuple(k) if isinstance(k, list) else k for k in key])] = (frames, mirrored)
+        self.base = pixelBase(header, size)
+        self.buf = buf
+
+    def __str__(self):
+        return "Pre-sliced pixels of every image, mapped from one file."
+
+    def __len__(self):
+        return len(self.entries)
+
+    def surface(self, (offset, w, h, alpha), colorkey):
+        img = pygame.image.frombuffer(buffer(self.buf, self.base+offset, w*h*4), (w,h), 'RGBA' if alpha else 'RGBX')
+        img.set_masks(ASSET_MASKS if alpha else ASSET_MASKS[:3] + (0,))
+        img.set_shifts(ASSET_SHIFTS if alpha else ASSET_SHIFTS[:3] + (0,))
+        #Left over the mapped file when that is already the display's layout
+        display = pygame.display.get_surface()
+        convert = display is not None and (display.get_bitsize() != 32 or display.get_masks()[:3] != ASSET_MASKS[:3])
+        if convert and not alpha and display.get_bitsize() != 32:
+            #SDL maps 32 bit pixels onto a palette as white; 24 bit ones it
+            #maps properly, so copy through one of those
+            copy = pygame.Surface((w,h), 0, 24)
+            copy.blit(img, (0,0))
+            img = copy
+        return toDisplayFormat(img, colorkey, convert)
+
+    def lookup(self, kind, key, colorkey=(255,255,255)):
+        entry = self.entries.get((kind, key))
+        if entry is None:
+            return None, None
+        frames, mirrored = entry
+        frames = [self.surface(frame, colorkey) for frame in frames]
+        if mirrored is not None:
+            mirrored = [self.surface(frame, colorkey) for frame in mirrored]
+        return frames, mirrored
+
+def pixelBase(header, size):
+    #Pixels start on the first 16 byte boundary after the index
+    return (header + size + 15) & ~15
+
+def assetPackIsStale(path=ASSET_PACK):
+    if not os.path.exists(path):
+        return True
+    built = os.path.getmtime(path)
+    for name in os.listdir('img'):
+        if name.endswith('.png') and os.path.getmtime(os.path.join('img', name)) > built:
+            return True
+    return False
+
+def writeAssetPack(assets, path=ASSET_PACK):
+    #Everything assets has loaded so far; run headless, so pixels are still
+    #the files' own rather than quantized to some display
+    index, blobs = [], []
+    offset = [0]
+    def add(images):
+        frames = []
+        for img in images:
+            alpha, data = packPixels(img)
+            frames.append([offset[0], img.get_width(), img.get_height(), alpha])
+            blobs.append(data)
+            offset[0] += len(data)
+        return frames
+    for (filepath, colorkey), img in sorted(assets.images.items()):
+        index.append(['image', [filepath, colorkey], add([img]), None])
+    for (filepath, w, h), images in sorted(assets.sprites.items()):
+        index.append(['sliced', [filepath, w, h], add(images), add(assets.mirrored(images))])
+    header = struct.calcsize('<4sBI')
+    text = json.dumps(index)
+    text = text.ljust(pixelBase(header, len(text)) - header)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    out = open(path + '.tmp', 'wb')
+    out.write(struct.pack('<4sBI', ASSET_MAGIC, ASSET_VERSION, len(text)))
+    out.write(text)
+    out.write(''.join(blobs))
+    out.close()
+    os.rename(path + '.tmp', path)
+    return path
+
+class RotationCache(object):
+    def __init__(self, img, step=ROTATION_STEP, maxsize=ROTATION_CACHE_SIZE, prebuild=ROTATION_PREBUILD):
+        self.img = img
+        self.step = step
+        self.buckets = int(round(360.0/step))
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.masks = {}
+        if prebuild:
+            for bucket in range(self.buckets):
+                self.get(bucket*step)
+                self.get(bucket*step, True)
+
+    def __str__(self):
+        return "LRU table of an image rotated in fixed angle steps."
+
+    def render(self, bucket, flipy):
+        img = pygame.transform.rotate(self.img, bucket*self.step)
+        if flipy:
+            img = pygame.transform.flip(img,0,1)
+        colorkey = img.get_colorkey()
+        if colorkey is not None:
+            img.set_colorkey(colorkey, RLEACCEL)
+        return img
+
+    def get(self, degrees, flipy=False):
+        key = (int(round(degrees/self.step)) % self.buckets, flipy)
+        img = self.cache.pop(key, None)
+        if img is None:
+            img = self.render(key[0], flipy)
+            if len(self.cache) >= self.maxsize:
+                self.cache.popitem(False)
+        self.cache[key] = img
+        return img
+
+    def mask(self, degrees, flipy=False):
+        #Kept for every bucket used; masks are far smaller than the images
+        key = (int(round(degrees/self.step)) % self.buckets, flipy)
+        if key not in self.masks:
+            self.masks[key] = pygame.mask.from_surface(self.get(degrees, flipy))
+        return self.masks[key]
+
+class GlyphAtlas(object):
+    CHARS = ''.join([chr(c) for c in range(32, 127)])
+
+    def __init__(self, font, color):
+        self.font = font
+        self.color = color
+        self.rects = {}
+        self.extra = {}
+        glyphs = [font.render(char, True, color) for char in self.CHARS]
+        width = sum([glyph.get_width() for glyph in glyphs])
+        self.sheet = pygame.Surface((max(width,1), font.get_linesize()), SRCALPHA, 32)
+        x = 0
+        for char, glyph in zip(self.CHARS, glyphs):
+            self.rects[char] = self.sheet.blit(glyph, (x,0))
+            x += glyph.get_width()
+        if pygame.display.get_surface() is not None:
+            self.sheet = self.sheet.convert_alpha()
+
+    def __str__(self):
+        return "Every printable character of one font and colour on a single sheet."
+
+    def blitChar(self, target, char, pos):
+        rect = self.rects.get(char)
+        if rect is not None:
+            return target.blit(self.sheet, pos, rect)
+        #Characters outside the sheet are rendered once on first use
+        if char not in self.extra:
+            self.extra[char] = self.font.render(char, True, self.color)
+        return target.blit(self.extra[char], pos)
+
+class AssetManager(object):
+    def __init__(self):
+        self.images = {}
+        self.sprites = {}
+        self.mirrors = {}
+        self.hitmasks = {}
+        self.solids = {}
+        self.rotated = {}
+        self.fonts = {}
+        self.backgrounds = {}
+        self.atlases = {}
+        self.pack = None
+        self.hits = 0
+        self.misses = 0
+
+    def __str__(self):
+        return "Process-wide cache of loaded images and fonts."
+
+    def lookup(self, cache, key, loader, *args):
+        if key in cache:
+            self.hits += 1
+            return cache[key]
+        self.misses += 1
+        cache[key] = loader(*args)
+        return cache[key]
+
+    def openPack(self, path=ASSET_PACK):
+        self.pack = AssetPack(path)
+        if not self.pack.entries:
+            self.pack = None
+
+    def unpack(self, kind, key, colorkey=(255,255,255)):
+        if self.pack is None:
+            return None, None
+        return self.pack.lookup(kind, key, colorkey)
+
+    def loadImage(self, filepath, colorkey):
+        images, mirrored = self.unpack('image', (filepath, colorkey), colorkey)
+        if images is not None:
+            return images[0]
+        return loadImage(filepath, colorkey)
+
+    def loadSliced(self, w, h, filepath):
+        images, mirrored = self.unpack('sliced', (filepath, w, h))
+        if images is None:
+            return loadSlicedSprites(w, h, filepath)
+        self.mirrors[id(images)] = (images, mirrored)
+        return images
+
+    def image(self, filepath, colorkey=(255,255,255)):
+        return self.lookup(self.images, (filepath, colorkey), self.loadImage, filepath, colorkey)
+
+    def sliced(self, w, h, filepath):
+        images = self.lookup(self.sprites, (filepath, w, h), self.loadSliced, w, h, filepath)
+        self.masks(images)
+        self.masks(self.mirrored(images))
+        return images
+
+    def mirrored(self, images):
+        #Keyed by id, so the entry keeps the source list alive
+        entry = self.mirrors.get(id(images))
+        if entry is None:
+            flipped = [toDisplayFormat(pygame.transform.flip(img,1,0)) for img in images]
+            entry = self.mirrors[id(images)] = (images, flipped)
+        return entry[1]
+
+    def mask(self, img):
+        #Keyed by id like mirrors; the entry keeps the surface alive
+        entry = self.hitmasks.get(id(img))
+        if entry is None:
+            entry = self.hitmasks[id(img)] = (img, pygame.mask.from_surface(img))
+        return entry[1]
+
+    def masks(self, images):
+        #One mask per animation frame of a sliced sheet or its mirror image
+        entry = self.hitmasks.get(id(images))
+        if entry is None:
+            entry = self.hitmasks[id(images)] = (images, [self.mask(img) for img in images])
+        return entry[1]
+
+    def solid(self, size):
+        if size not in self.solids:
+            self.solids[size] = pygame.Mask(size)
+            self.solids[size].fill()
+        return self.solids[size]
+
+    def rotations(self, filepath, step=ROTATION_STEP):
+        key = (filepath, step)
+        if key not in self.rotated:
+            self.rotated[key] = RotationCache(self.image(filepath), step)
+        return self.rotated[key]
+
+    def font(self, name, size, sysfont=False):
+        if sysfont:
+            return self.lookup(self.fonts, ('sys', name, size), pygame.font.SysFont, name, size)
+        return self.lookup(self.fonts, ('file', name, size), pygame.font.Font, name, size)
+
+    def atlas(self, name, size, color, sysfont=False):
+        key = (name, size, color, sysfont)
+        if key not in self.atlases:
+            self.atlases[key] = GlyphAtlas(self.font(name, size, sysfont), color)
+        return self.atlases[key]
+
+    def parallax(self, layers):
+        return self.lookup(self.backgrounds, layers, Parallax, layers)
+
+    def surfaces(self):
+        for img in self.images.values():
+            yield img
+        for background in self.backgrounds.values():
+            for surf, speed, rows in background.passes:
+                if not isinstance(surf, tuple):
+                    yield surf
+        for atlas in self.atlases.values():
+            yield atlas.sheet
+        for images in self.sprites.values():
+            for img in images:
+                yield img
+        for images, flipped in self.mirrors.values():
+            for img in flipped:
+                yield img
+        for rotations in self.rotated.values():
+            for img in rotations.cache.values():
+                yield img
+
+    def memoryUsage(self):
+        total = 0
+        for img in self.surfaces():
+            w, h = img.get_size()
+            total += w*h*img.get_bytesize()
+        return total
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'images': len(self.images),
+                'sprite_sheets': len(self.sprites),
+                'fonts': len(self.fonts),
+                'packed': len(self.pack or ()),
+                'bytes': self.memoryUsage()}
+
+    def clear(self):
+        self.images.clear()
+        self.sprites.clear()
+        self.mirrors.clear()
+        self.hitmasks.clear()
+        self.solids.clear()
+        self.rotated.clear()
+        self.fonts.clear()
+        self.backgrounds.clear()
+        self.atlases.clear()
+
+ASSETS = AssetManager()
+
+def cellsCovering(rect, size):
+    return [(cx,cy) for cx in range(rect.left//size, (rect.right-1)//size+1)
+                    for cy in range(rect.top//size, (rect.bottom-1)//size+1)]
+
+def audioPath(filepath):
+    compressed = os.path.splitext(filepath)[0] + '.ogg'
+    if os.path.exists(compressed):
+        return compressed
+    return filepath
+
+def loadSound(filepath):
+    if not pygame.mixer.get_init():
+        return None
+    return pygame.mixer.Sound(audioPath(filepath))
+
+class AudioBank(object):
+    def __init__(self, channels=AUDIO_CHANNELS):
+        self.size = channels
+        self.channels = []
+        self.started = []
+        self.sounds = {}
+        self.limits = {}
+        self.lastplay = {}
+
+    def __str__(self):
+        return "Decoded sound effects played through a fixed set of channels."
+
+    def init(self, sounds=SOUNDS):
+        if not pygame.mixer.get_init():
+            return
+        pygame.mixer.set_num_channels(self.size)
+        self.channels = [pygame.mixer.Channel(i) for i in range(self.size)]
+        self.started = [0.0]*self.size
+        for name, (filepath, limit) in sounds.items():
+            self.sounds[name] = loadSound(filepath)
+            self.limits[name] = limit/1000.0
+
+    def play(self, name):
+        sound = self.sounds.get(name)
+        if sound is None:
+            return None
+        now = default_timer()
+        if now - self.lastplay.get(name, -1000.0) < self.limits[name]:
+            return None
+        self.lastplay[name] = now
+        #A free channel if there is one, otherwise steal the oldest voice
+        i = min(range(self.size), key=lambda i: (self.channels[i].get_busy(), self.started[i]))
+        self.channels[i].play(sound)
+        self.started[i] = now
+        return self.channels[i]
+
+    def music(self, filepath=MUSIC, loops=-1):
+        if not pygame.mixer.get_init():
+            return
+        #pygame.mixer.music streams from disk rather than decoding up front
+        pygame.mixer.music.load(audioPath(filepath))
+        pygame.mixer.music.play(loops)
+
+    def stop(self):
+        for channel in self.channels:
+            channel.stop()
+
+AUDIO = AudioBank()
+
 def terminate():
     pygame.quit()
     sys.exit()
@@ -58,43 +564,795 @@ def checkSide(dx,dy):
     else:
         return 0, 0
 
-def fadeToBlack():
-    for i in range(30):
-        DISPLAYSURF.fill((7,7,7),None,BLEND_SUB)
-        pygame.display.update()
-        FPSCLOCK.tick(FPS)
+def fadeOut(target, frames=30):
+    #Scheduler task: darkens whatever target draws by a step each tick
+    for i in range(frames):
+        target.fade = i+1
+        yield
+
+def drawFade(amount):
+    if amount:
+        DISPLAYSURF.fill((7*amount,7*amount,7*amount),None,BLEND_SUB)
+        DIRTY.markAll()
+
+class FrameProfiler(object):
+    COLUMNS = ['frame', 'input', 'map update', 'player input', 'player collide',
+               'bullets', 'saws', 'background', 'tiles', 'map sprites', 'player draw',
+               'speech bubbles', 'overlay', 'display flip', 'blits', 'collision tests', 'input lag']
+
+    def __init__(self, window=PROFILE_WINDOW):
+        self.enabled = False
+        self.overlay = False
+        self.frames = deque(maxlen=window)
+        self.current = None
+        self.counters = None
+        self.start = 0.0
+        self.last = 0.0
+        self.log = None
+        self.header = False
+
+    def __str__(self):
+        return "Per-frame stage timings and counters."
+
+    def open(self, path):
+        self.log = open(path, 'w')
+        self.header = False
+        self.enabled = True
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+        self.enabled = self.overlay
+
+    def toggleOverlay(self):
+        self.overlay = not self.overlay
+        self.enabled = self.overlay or self.log is not None
+
+    def begin(self):
+        if not self.enabled:
+            return
+        self.current = {}
+        self.counters = {}
+        self.start = self.last = default_timer()
+
+    def lap(self, name):
+        #Charges the time since the previous lap to name
+        if self.current is None:
+            return
+        now = default_timer()
+        self.current[name] = self.current.get(name, 0.0) + (now-self.last)*1000.0
+        self.last = now
+
+    def count(self, name, n=1):
+        if self.current is not None:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def end(self):
+        if self.current is None:
+            return
+        self.current['frame'] = (default_timer()-self.start)*1000.0
+        self.frames.append((self.current, self.counters))
+        if self.log is not None:
+            self.write(self.current, self.counters)
+        self.current = None
+        self.counters = None
+
+    def write(self, times, counters):
+        row = dict(times)
+        row.update(counters)
+        if self.log.name.endswith('.csv'):
+            if not self.header:
+                self.log.write(','.join(self.COLUMNS) + '\n')
+                self.header = True
+            self.log.write(','.join(['%.3f' % row.get(c, 0) for c in self.COLUMNS]) + '\n')
+        else:
+            self.log.write(json.dumps(row, sort_keys=True) + '\n')
+
+    def summary(self):
+        stats = {}
+        for times, counters in self.frames:
+            for name, value in times.items() + counters.items():
+                total, worst = stats.get(name, (0.0, 0.0))
+                stats[name] = (total + value, max(worst, value))
+        n = max(len(self.frames), 1)
+        return [(name, total/n, worst) for name, (total, worst) in sorted(stats.items())]
+
+    def draw(self):
+        if not self.overlay:
+            return
+        y = 5
+        for name, avg, worst in self.summary():
+            text = SMALLFONT.render('%-16s %7.2f %7.2f' % (name, avg, worst), True, (255,255,0), (0,0,0))
+            #Screen coordinates, unlike blit()
+            DIRTY.mark(DISPLAYSURF.blit(text, (5, y)))
+            y += text.get_height()
+
+PROFILER = FrameProfiler()
+if PROFILE_LOG:
+    PROFILER.open(PROFILE_LOG)
+
+class SimClock(object):
+    def __init__(self, step=1000.0/FPS):
+        self.step = step
+        self.ticks = 0
+        self.now = 0
+        self.alpha = 1.0
+
+    def __str__(self):
+        return "Game time in milliseconds, advanced once per logic tick."
+
+    def advance(self):
+        self.ticks += 1
+        self.now = int(self.ticks*self.step)
+
+    def reset(self, ticks=0):
+        self.ticks = ticks
+        self.now = int(ticks*self.step)
+
+SIMCLOCK = SimClock()
+
+class Scheduler(object):
+    def __init__(self):
+        self.tasks = []
+
+    def __str__(self):
+        return "Generator tasks stepped once per simulation tick."
+
+    def spawn(self, task):
+        self.tasks.append(task)
+        return task
+
+    def running(self, task):
+        return task in self.tasks
+
+    def update(self):
+        for task in list(self.tasks):
+            try:
+                task.next()
+            except StopIteration:
+                self.tasks.remove(task)
+
+    def clear(self):
+        del self.tasks[:]
+
+SCHEDULER = Scheduler()
+
+def tween(frames, step):
+    #Calls step(t) with t rising to 1.0 over the given number of ticks
+    for i in range(frames):
+        step(float(i+1)/frames)
+        yield
+
+class InputState(object):
+    def __init__(self, keys=(), mouse_pos=(0,0), mouse_buttons=(0,0,0)):
+        self.keys = frozenset(keys)
+        self.mouse_pos = tuple(mouse_pos)
+        self.mouse_buttons = tuple(mouse_buttons)
+
+    def __str__(self):
+        return "Keys held and mouse state for one logic tick."
+
+    def __getitem__(self, key):
+        return key in self.keys
+
+    @staticmethod
+    def capture():
+        pressed = pygame.key.get_pressed()
+        keys = [k for k in range(len(pressed)) if pressed[k]]
+        return InputState(keys, pygame.mouse.get_pos(), pygame.mouse.get_pressed())
+
+    def state(self):
+        return (self.keys, self.mouse_pos, self.mouse_buttons)
+
+class InputBuffer(object):
+    def __init__(self, bindings=KEY_BINDINGS):
+        self.bindings = dict(bindings)
+        self.events = deque()
+        self.held = set()
+        self.buttons = [0,0,0]
+        self.mouse_pos = (0,0)
+        self.lag = 0
+
+    def __str__(self):
+        return "Timestamped key and button events, folded into one InputState per tick."
+
+    def bind(self, physical, logical):
+        self.bindings[physical] = logical
+
+    def unbind(self, physical):
+        self.bindings.pop(physical, None)
+
+    def reset(self):
+        #Forgets everything held, so a key that ended one screen is only
+        #seen by the next if it is pressed again
+        self.events.clear()
+        self.held.clear()
+        self.buttons = [0,0,0]
+
+    def pump(self):
+        #Drains the event queue once per frame. Every event is handed back
+        #so the caller can still see QUIT and hotkeys
+        now = pygame.time.get_ticks()
+        events = pygame.event.get()
+        for event in events:
+            if event.type in (KEYDOWN, KEYUP):
+                self.events.append((now, event.type, self.bindings.get(event.key, event.key)))
+            elif event.type in (MOUSEBUTTONDOWN, MOUSEBUTTONUP) and 1 <= event.button <= 3:
+                self.events.append((now, event.type, event.button-1))
+            elif event.type == ACTIVEEVENT and event.state & 2 and not event.gain:
+                #Key ups are not seen once focus is lost
+                self.events.append((now, ACTIVEEVENT, None))
+        self.mouse_pos = pygame.mouse.get_pos()
+        return events
+
+    def snapshot(self):
+        #Keys and buttons pressed since the last tick count as held for this
+        #one, so taps shorter than a tick are not lost. lag is how long the
+        #oldest event waited for a tick, in milliseconds
+        keys = set()
+        buttons = [0,0,0]
+        self.lag = pygame.time.get_ticks() - self.events[0][0] if self.events else 0
+        while self.events:
+            t, kind, code = self.events.popleft()
+            if kind == KEYDOWN:
+                self.held.add(code)
+                keys.add(code)
+            elif kind == KEYUP:
+                self.held.discard(code)
+            elif kind == MOUSEBUTTONDOWN:
+                self.buttons[code] = buttons[code] = 1
+            elif kind == MOUSEBUTTONUP:
+                self.buttons[code] = 0
+            else:
+                self.held.clear()
+                self.buttons = [0,0,0]
+        keys.update(self.held)
+        return InputState(keys, self.mouse_pos, [max(b) for b in zip(buttons, self.buttons)])
+
+INPUT = InputBuffer()
+
+class InputRecorder(object):
+    #Runs of identical ticks: <H repeat, <hhB mouse and buttons, <B key
+    #count, then <H per key
+    def __init__(self, path):
+        self.out = open(path + '.tmp', 'wb')
+        self.path = path
+        self.out.write(struct.pack('<4sB', INPUT_MAGIC, INPUT_VERSION))
+        self.last = None
+        self.repeat = 0
+
+    def __str__(self):
+        return "Writes InputStates to a compact binary file."
+
+    def write(self, inp):
+        state = inp.state()
+        if state == self.last and self.repeat < 0xffff:
+            self.repeat += 1
+            return
+        self.flush()
+        self.last = state
+        self.repeat = 1
+
+    def flush(self):
+        if self.last is None:
+            return
+        keys, (mx, my), buttons = self.last
+        bits = sum([1 << i for i, b in enumerate(buttons) if b])
+        keys = sorted(keys)
+        self.out.write(struct.pack('<HhhBB%dH' % len(keys), self.repeat, mx, my, bits, len(keys), *keys))
+
+    def close(self):
+        self.flush()
+        self.out.close()
+        os.rename(self.path + '.tmp', self.path)
+
+def readInputRecording(path):
+    data = open(path, 'rb').read()
+    magic, version = struct.unpack_from('<4sB', data)
+    if magic != INPUT_MAGIC or version != INPUT_VERSION:
+        raise IOError('%s: not an input recording' % path)
+    offset = struct.calcsize('<4sB')
+    head = struct.calcsize('<HhhBB')
+    while offset < len(data):
+        repeat, mx, my, bits, n = struct.unpack_from('<HhhBB', data, offset)
+        keys = struct.unpack_from('<%dH' % n, data, offset+head)
+        offset += head + 2*n
+        inp = InputState(keys, (mx, my), [(bits >> i) & 1 for i in range(3)])
+        for i in range(repeat):
+            yield inp
+
+class DirtyRects(object):
+    def __init__(self, enabled=DIRTY_RECTS, threshold=DIRTY_THRESHOLD):
+        self.enabled = enabled
+        self.threshold = threshold
+        self.rects = []
+        self.previous = []
+        self.full = True
+        self.fullflips = 0
+        self.partialflips = 0
+
+    def __str__(self):
+        return "Screen regions changed since the last display update."
+
+    def mark(self, rect):
+        if self.enabled:
+            self.rects.append(pygame.Rect(rect))
+
+    def markAll(self):
+        self.full = True
+
+    def flush(self):
+        #Last frame's rects are pushed again so whatever moved away gets erased
+        screen = pygame.Rect(0, 0, WINDOWWIDTH, WINDOWHEIGHT)
+        rects = set([tuple(r.clip(screen)) for r in self.previous + self.rects])
+        rects = [pygame.Rect(r) for r in rects if r[2] and r[3]]
+        area = sum([r.w*r.h for r in rects])
+        if not self.enabled or self.full or area > self.threshold*screen.w*screen.h:
+            pygame.display.update()
+            self.fullflips += 1
+        else:
+            pygame.display.update(rects)
+            self.partialflips += 1
+        self.previous = self.rects
+        self.rects = []
+        self.full = False
+
+DIRTY = DirtyRects()
+
+class Camera(object):
+    def __init__(self, w=WINDOWWIDTH, h=WINDOWHEIGHT):
+        self.rect = pygame.Rect(0, 0, w, h)
+        self.bounds = self.rect.copy()
+        self.prev = (0,0)
+        self.offset = (0,0)
+
+    def __str__(self):
+        return "The window onto the world, kept centred on a target within the level bounds."
+
+    def reset(self, bounds, target):
+        #Levels smaller than the window stay pinned to the top left
+        self.bounds = bounds.union((0, 0, self.rect.w, self.rect.h))
+        if self.bounds.w - self.rect.w <= CAMERA_SLACK:
+            self.bounds.w = self.rect.w
+        if self.bounds.h - self.rect.h <= CAMERA_SLACK:
+            self.bounds.h = self.rect.h
+        self.rect.center = target
+        self.rect.clamp_ip(self.bounds)
+        self.prev = self.offset = self.rect.topleft
+
+    def follow(self, target):
+        self.prev = self.rect.topleft
+        self.rect.center = target
+        self.rect.clamp_ip(self.bounds)
+
+    def interpolate(self, alpha):
+        offset = (int(self.prev[0] + (self.rect.x-self.prev[0])*alpha),
+                  int(self.prev[1] + (self.rect.y-self.prev[1])*alpha))
+        moved = offset != self.offset
+        self.offset = offset
+        return moved
+
+    def view(self):
+        return pygame.Rect(self.offset, self.rect.size)
+
+    def toWorld(self, pos):
+        return (pos[0]+self.rect.x, pos[1]+self.rect.y)
+
+    def toScreen(self, pos):
+        return (pos[0]-self.offset[0], pos[1]-self.offset[1])
+
+CAMERA = Camera()
+
+def blit(img, pos, area=None):
+    #pos is in world coordinates
+    rect = DISPLAYSURF.blit(img, CAMERA.toScreen(pos), area)
+    DIRTY.mark(rect)
+    PROFILER.count('blits')
+    return rect
+
+def updateDisplay():
+    DIRTY.flush()
+
+def scrollBand(img):
+    #Full-width strip covering the opaque rows of a scrolling layer
+    band = img.get_bounding_rect()
+    return pygame.Rect(0, band.y, WINDOWWIDTH, band.h)
+
+class Parallax(object):
+    def __init__(self, layers):
+        self.passes = []
+        bands = []
+        static = []
+        for source, speed in layers:
+            if not speed:
+                static.append(source)
+                continue
+            self.flatten(static)
+            img = ASSETS.image(source)
+            bands.append(scrollBand(img))
+            self.passes.append(self.strip(img, speed))
+        self.flatten(static)
+        self.band = None
+        if bands:
+            self.band = bands[0].unionall(bands[1:])
+
+    def __str__(self):
+        return "Scrolling background built from flattened and pre-tiled layers."
+
+    def surface(self, size):
+        surf = pygame.Surface(size)
+        if pygame.display.get_surface() is not None:
+            surf = surf.convert()
+        return surf
+
+    def flatten(self, sources):
+        if not sources:
+            return
+        if len(sources) == 1 and isinstance(sources[0], tuple):
+            #A lone colour is cheaper to fill than to blit
+            self.passes.append((sources[0], 0, None))
+            del sources[:]
+            return
+        surf = self.surface((WINDOWWIDTH, WINDOWHEIGHT))
+        surf.fill(CHUNK_COLORKEY)
+        for source in sources:
+            if isinstance(source, tuple):
+                surf.fill(source)
+            else:
+                surf.blit(ASSETS.image(source), (0,0))
+        #RLE skips the transparent runs and is no slower on opaque ones
+        surf.set_colorkey(CHUNK_COLORKEY, RLEACCEL)
+        self.passes.append((surf, 0, None))
+        del sources[:]
+
+    def strip(self, img, speed):
+        #Opaque rows of the image tiled past one screen width, so any scroll
+        #offset is a single blit
+        w = img.get_width()
+        rows = scrollBand(img)
+        surf = self.surface((w+WINDOWWIDTH, rows.h))
+        surf.fill(CHUNK_COLORKEY)
+        for x in range(0, w+WINDOWWIDTH, w):
+            surf.blit(img, (x, -rows.y))
+        surf.set_colorkey(CHUNK_COLORKEY, RLEACCEL)
+        return surf, speed, rows
+
+    def draw(self, x):
+        for surf, speed, rows in self.passes:
+            if isinstance(surf, tuple):
+                DISPLAYSURF.fill(surf)
+                continue
+            if not speed:
+                DISPLAYSURF.blit(surf, (0,0))
+                continue
+            offset = (speed*x) % (surf.get_width()-WINDOWWIDTH)
+            DISPLAYSURF.blit(surf, rows.topleft, (offset, 0, WINDOWWIDTH, rows.h))
+        if self.band is not None:
+            DIRTY.mark(self.band)
 
 class SpeechBubble(pygame.sprite.Sprite):
     def __init__(self,x,y,txt):
         pygame.sprite.Sprite.__init__(self)
-        self.texts = []
-        for char in txt:
-            self.texts.append(SMALLFONT.render(char, True, (0,0,0)))
+        self.atlas = ASSETS.atlas('monospace', 14, (0,0,0), True)
+        self.txt = txt
         self.x = x
         self.y = y
 
         self.count = 1
+        #Bubble and tail are drawn once; draw() only appends new characters
+        h = max(55, (len(txt)+10)/11*10)
+        self.image = pygame.Surface((105,h+16))
+        if pygame.display.get_surface() is not None:
+            self.image = self.image.convert()
+        self.image.set_colorkey(CHUNK_COLORKEY)
+        self.clear()
+
+    def clear(self):
+        h = self.image.get_height()-16
+        self.image.fill(CHUNK_COLORKEY)
+        pygame.draw.rect(self.image, (255,255,255), (5,0,100,h))
+        pygame.draw.polygon(self.image, (255,255,255), ((10,h),(25,h),(0,h+15)))
+        self.shown = 0
+
+    def __str__(self):
+        return "Tutorial text typed out one character per tick."
 
     def draw(self):
-        pygame.draw.rect(DISPLAYSURF, (255,255,255), (self.x,self.y,100,55))
-        pygame.draw.polygon(DISPLAYSURF, (255,255,255), ((self.x+5,self.y+55),(self.x+20,self.y+55),(self.x-5,self.y+70)))
-        for i in range(self.count):
-            DISPLAYSURF.blit(self.texts[i],(self.x+(i%11)*9,self.y+(i/11)*10))
-        if self.count<len(self.texts):
-            self.count += 1
+        while self.shown < self.count:
+            i = self.shown
+            self.atlas.blitChar(self.image, self.txt[i], (5+(i%11)*9,(i/11)*10))
+            self.shown += 1
+        blit(self.image,(self.x-5,self.y))
 
     def next_msg(self):
         self.kill()
-        
+
+    def rewind(self,(x,y,count)):
+        self.x = x
+        self.y = y
+        self.count = count
+        if self.shown > count:
+            self.clear()
+
     def update(self,x,y):
         self.x = x
         self.y = y
-        self.draw()
+        if self.count<len(self.txt):
+            self.count += 1
     
+class SpatialGrid(object):
+    def __init__(self, cellsize=TILESIZE):
+        self.cellsize = cellsize
+        self.cells = {}
+        self.members = {}
+
+    def __str__(self):
+        return "Uniform grid bucketing sprites by the cells their rects overlap."
+
+    def cellsFor(self, rect):
+        return cellsCovering(rect, self.cellsize)
+
+    def add(self, spr):
+        if spr in self.members:
+            self.update(spr)
+            return
+        keys = self.cellsFor(spr.rect)
+        for key in keys:
+            self.cells.setdefault(key, set()).add(spr)
+        self.members[spr] = keys
+
+    def remove(self, spr):
+        keys = self.members.pop(spr, ())
+        for key in keys:
+            cell = self.cells.get(key)
+            if cell is not None:
+                cell.discard(spr)
+                if not cell:
+                    del self.cells[key]
+
+    def update(self, spr):
+        #Only re-buckets sprites that are already indexed
+        if spr not in self.members:
+            return
+        keys = self.cellsFor(spr.rect)
+        if keys != self.members[spr]:
+            self.remove(spr)
+            self.add(spr)
+
+    def query(self, rect):
+        found = set()
+        cells = self.cells
+        for key in self.cellsFor(rect):
+            cell = cells.get(key)
+            if cell:
+                found.update(cell)
+        return found
+
+    def collide(self, rect, groups):
+        hits = []
+        candidates = self.query(rect)
+        PROFILER.count('collision tests', len(candidates))
+        for obj in candidates:
+            if obj.rect.colliderect(rect):
+                for group in groups:
+                    if obj in group:
+                        hits.append(obj)
+                        break
+        return hits
+
+    def collideMask(self, spr, groups, margin=MASK_MARGIN):
+        #Rect broad phase over everything the masks could reach, then a
+        #pixel test on what it finds
+        mask, pos = spr.hitMask()
+        bounds = pygame.Rect(pos, mask.get_size()).inflate(2*margin, 2*margin)
+        return [obj for obj in self.collide(bounds, groups) if spr.overlaps(obj)]
+
+class StoreField(object):
+    #Reads and writes one column of the sprite's EntityStore slot, so the
+    #sprite keeps its plain attribute while the value lives in the arrays
+    def __init__(self, name, kind=int):
+        self.name = name
+        self.kind = kind
+
+    def __get__(self, spr, cls):
+        if spr is None:
+            return self
+        return self.kind(spr.store.columns[self.name][spr.slot])
+
+    def __set__(self, spr, value):
+        spr.store.columns[self.name][spr.slot] = value
+
+class EntityStore(object):
+    #Columns of the per-tick state of one kind of sprite, stepped for a
+    #batch of slots at once rather than through one update() per sprite
+    fields = ()
+
+    def __init__(self, capacity=16):
+        self.capacity = 0
+        self.sprites = []
+        self.columns = {}
+        self.grow(capacity)
+
+    def __str__(self):
+        return "Arrays of the moving parts of one kind of sprite."
+
+    def __len__(self):
+        return len(self.sprites)
+
+    def grow(self, capacity):
+        for name in self.fields:
+            old = self.columns.get(name)
+            if numpy is not None:
+                column = numpy.zeros(capacity, int)
+                if old is not None:
+                    column[:self.capacity] = old
+            else:
+                column = (old or []) + [0]*(capacity-self.capacity)
+            self.columns[name] = column
+        self.capacity = capacity
+
+    def attach(self, spr):
+        if len(self.sprites) == self.capacity:
+            self.grow(self.capacity*2)
+        spr.store = self
+        spr.slot = len(self.sprites)
+        self.sprites.append(spr)
+
+    def detach(self, spr):
+        #The last sprite moves into the freed slot so the columns stay packed
+        last = self.sprites.pop()
+        if last is not spr:
+            for column in self.columns.values():
+                column[spr.slot] = column[last.slot]
+            last.slot = spr.slot
+            self.sprites[spr.slot] = last
+        spr.store = spr.slot = None
+
+    def snapshot(self):
+        if numpy is not None:
+            return dict([(name, column[:len(self)].copy()) for name, column in self.columns.items()])
+        return dict([(name, column[:len(self)]) for name, column in self.columns.items()])
+
+    def restore(self, state):
+        for name, column in state.items():
+            self.columns[name][:len(column)] = column
+        xs, ys = self.corners(self.slots(self.sprites))
+        for spr, x, y in zip(self.sprites, xs, ys):
+            spr.rect.topleft = (int(x), int(y))
+            spr.swapping = False
+            spr.reindex()
+
+    def slots(self, sprites):
+        slots = [spr.slot for spr in sprites]
+        if numpy is not None:
+            return numpy.array(slots, int)
+        return slots
+
+    def sync(self, slots, xs, ys, moved):
+        #Copies new positions back to the rects and re-buckets only the
+        #sprites that crossed a cell edge
+        sprites = self.sprites
+        if numpy is not None:
+            slots, xs, ys, moved = slots.tolist(), xs.tolist(), ys.tolist(), moved.tolist()
+        for i, x, y, m in zip(slots, xs, ys, moved):
+            spr = sprites[i]
+            spr.rect.topleft = (x, y)
+            if m:
+                spr.reindex()
+
+    def corners(self, slots):
+        #Top left corners of the rects, from whatever the columns store
+        c = self.columns
+        if numpy is not None:
+            return c['x'][slots], c['y'][slots]
+        return [c['x'][i] for i in slots], [c['y'][i] for i in slots]
+
+    def crossed(self, x0, y0, x1, y1, w, h):
+        size = TILESIZE
+        return ((x0//size != x1//size) | ((x0+w-1)//size != (x1+w-1)//size) |
+                (y0//size != y1//size) | ((y0+h-1)//size != (y1+h-1)//size))
+
+class SawStore(EntityStore):
+    #Enemy rects patrol between min and max, turning round past either end
+    fields = ('x', 'y', 'w', 'h', 'dx', 'min', 'max', 'facingleft', 'frame', 'last_update')
+
+    def __init__(self, capacity=16):
+        EntityStore.__init__(self, capacity)
+        self.frames = len(ASSETS.sliced(80,30,'img/saw.png'))
+
+    def step(self, sprites):
+        if not sprites:
+            return
+        c = self.columns
+        slots = self.slots(sprites)
+        now = SIMCLOCK.now
+        if numpy is not None:
+            due = (now - c['last_update'][slots]) > 3000/FPS
+            frame = c['frame'][slots] + due
+            frame[frame >= self.frames] = 0
+            c['frame'][slots] = frame
+            c['last_update'][slots[due]] = now
+            x0 = c['x'][slots]
+            x = x0 + c['dx'][slots]
+            turn = (x > c['max'][slots]) | (x < c['min'][slots])
+            c['facingleft'][slots[turn]] ^= 1
+            c['dx'][slots[turn]] *= -1
+            c['x'][slots] = x
+            y = c['y'][slots]
+            moved = self.crossed(x0, y, x, y, c['w'][slots], c['h'][slots])
+            self.sync(slots, x, y, moved)
+            return
+        xs, ys, moved = [], [], []
+        for i in slots:
+            if now - c['last_update'][i] > 3000/FPS:
+                c['frame'][i] += 1
+                c['last_update'][i] = now
+            if c['frame'][i] >= self.frames:
+                c['frame'][i] = 0
+            x0 = c['x'][i]
+            c['x'][i] += c['dx'][i]
+            if c['x'][i] > c['max'][i] or c['x'][i] < c['min'][i]:
+                c['facingleft'][i] ^= 1
+                c['dx'][i] = -c['dx'][i]
+            xs.append(c['x'][i])
+            ys.append(c['y'][i])
+            moved.append(self.crossed(x0, ys[-1], xs[-1], ys[-1], c['w'][i], c['h'][i]))
+        self.sync(slots, xs, ys, moved)
+
+class SwitchStore(EntityStore):
+    #Moving switch centres bounce off a box around their midpoint
+    fields = ('x', 'y', 'w', 'h', 'dx', 'dy', 'midx', 'midy', 'xmax', 'ymax')
+
+    def corners(self, slots):
+        c = self.columns
+        if numpy is not None:
+            return c['x'][slots] - c['w'][slots]/2, c['y'][slots] - c['h'][slots]/2
+        return [c['x'][i] - c['w'][i]/2 for i in slots], [c['y'][i] - c['h'][i]/2 for i in slots]
+
+    def step(self, sprites):
+        if not sprites:
+            return
+        c = self.columns
+        slots = self.slots(sprites)
+        if numpy is not None:
+            w, h = c['w'][slots], c['h'][slots]
+            x0, y0 = c['x'][slots], c['y'][slots]
+            x, y = x0 + c['dx'][slots], y0 + c['dy'][slots]
+            midx, midy = c['midx'][slots], c['midy'][slots]
+            xmax, ymax = c['xmax'][slots], c['ymax'][slots]
+            c['dx'][slots[(x > midx+xmax) | (x < midx-xmax)]] *= -1
+            c['dy'][slots[(y > midy+ymax) | (y < midy-ymax)]] *= -1
+            c['x'][slots], c['y'][slots] = x, y
+            moved = self.crossed(x0-w/2, y0-h/2, x-w/2, y-h/2, w, h)
+            self.sync(slots, x-w/2, y-h/2, moved)
+            return
+        xs, ys, moved = [], [], []
+        for i in slots:
+            w, h = c['w'][i], c['h'][i]
+            x0, y0 = c['x'][i], c['y'][i]
+            c['x'][i] += c['dx'][i]
+            c['y'][i] += c['dy'][i]
+            if c['x'][i] > c['midx'][i] + c['xmax'][i] or c['x'][i] < c['midx'][i] - c['xmax'][i]:
+                c['dx'][i] = -c['dx'][i]
+            if c['y'][i] > c['midy'][i] + c['ymax'][i] or c['y'][i] < c['midy'][i] - c['ymax'][i]:
+                c['dy'][i] = -c['dy'][i]
+            xs.append(c['x'][i]-w/2)
+            ys.append(c['y'][i]-h/2)
+            moved.append(self.crossed(x0-w/2, y0-h/2, xs[-1], ys[-1], w, h))
+        self.sync(slots, xs, ys, moved)
+
 class Collidable(pygame.sprite.Sprite):
+    #Set by EntityStore.attach for sprites whose state lives in a store
+    store = None
+    slot = None
+
     def __init__(self):
         pygame.sprite.Sprite.__init__(self)
         self.collision_groups = []
+        self.grid = None
+        self.actors = None
+        self.swapping = False
 
     def __str__(self):
         return "Objects that are collidable within the environment."
@@ -103,22 +1361,56 @@ class Collidable(pygame.sprite.Sprite):
         if group not in self.collision_groups:
             self.collision_groups.append(group)
 
+    def nearby(self):
+        if self.grid is not None:
+            for obj in self.grid.query(self.rect):
+                for group in self.collision_groups:
+                    if obj in group:
+                        yield obj
+                        break
+        else:
+            for group in self.collision_groups:
+                for obj in group:
+                    yield obj
+
+    def hitMask(self):
+        #Mask of the drawn pixels and where it sits in the world
+        return ASSETS.solid(self.rect.size), self.rect.topleft
+
+    def overlaps(self, other):
+        mask, (x, y) = self.hitMask()
+        othermask, (ox, oy) = other.hitMask()
+        return mask.overlap(othermask, (ox-x, oy-y)) is not None
+
+    def colliding(self):
+        if self.grid is not None:
+            return self.grid.collide(self.rect, self.collision_groups)
+        return [obj for obj in self.nearby() if obj.rect.colliderect(self.rect)]
+
+    def reindex(self):
+        if self.grid is not None:
+            self.grid.update(self)
+        if self.actors is not None:
+            self.actors.update(self)
+
     def move(self, dx, dy, collide=True):
         if collide:
             if dx!=0:
                 self.rect.x += dx
                 side = checkSide(dx, 0)
-                for group in self.collision_groups:
-                    for obj in group:
-                        if obj.rect.colliderect(self.rect):
-                            self.onCollision(side, obj)
+                objs = list(self.nearby())
+                PROFILER.count('collision tests', len(objs))
+                for obj in objs:
+                    if obj.rect.colliderect(self.rect):
+                        self.onCollision(side, obj)
             if dy!=0:
                 self.rect.y += dy
                 side = checkSide(0, dy)
-                for group in self.collision_groups:
-                    for obj in group:
-                        if obj.rect.colliderect(self.rect):
-                            self.onCollision(side, obj)
+                objs = list(self.nearby())
+                PROFILER.count('collision tests', len(objs))
+                for obj in objs:
+                    if obj.rect.colliderect(self.rect):
+                        self.onCollision(side, obj)
         else:
             self.rect.x += dx
             self.rect.y += dy
@@ -136,13 +1428,52 @@ class Collidable(pygame.sprite.Sprite):
     def onCollision(self, side, obj):
         self.toSide(obj, side)
 
+    def onShot(self, shooter):
+        #Called when a projectile from shooter hits this; the projectile always dies
+        pass
+
+    def placed(self):
+        #Called after the rect is set by hand, for sprites that keep a copy
+        pass
+
+    def savePosition(self):
+        self.prevpos = self.rect.topleft
+
+    def drawOffset(self):
+        #Pulls the drawn position back towards the previous tick
+        prev = getattr(self, 'prevpos', None)
+        if prev is None or SIMCLOCK.alpha >= 1.0:
+            return 0, 0
+        t = 1.0 - SIMCLOCK.alpha
+        return int(round((prev[0]-self.rect.x)*t)), int(round((prev[1]-self.rect.y)*t))
+
+    def animate(self,t,images):
+        if t-self.last_update > 3000/FPS:
+            self.frame += 1
+            if self.frame>=len(images):
+                self.frame = 0
+            self.last_update = t
+        if self.frame >= len(images):
+            self.frame = 0
+
         
 class Enemy(Collidable):
-    def __init__(self,(x,y),key):
+    dx = StoreField('dx')
+    min = StoreField('min')
+    max = StoreField('max')
+    facingleft = StoreField('facingleft', bool)
+    frame = StoreField('frame')
+    last_update = StoreField('last_update')
+
+    def __init__(self,(x,y),key,store=None):
         Collidable.__init__(self)
-        self.img = loadSlicedSprites(80,30,'img/saw.png')
+        if store is None:
+            store = SawStore(1)
+        store.attach(self)
+        self.img = ASSETS.sliced(80,30,'img/saw.png')
         self.rect = pygame.Rect(x,y,60,30)
         self.rect.center = (x,y+5)
+        self.placed()
         self.frame = 0
         self.facingleft = False
         self.last_update = 0
@@ -152,28 +1483,29 @@ class Enemy(Collidable):
         self.min = x - int(key[0])
         self.max = x + int(key[1])
 
-    def draw(self,t,images):
-        if t-self.last_update > 3000/FPS:
-            self.frame += 1
-            if self.frame>=len(images):
-                self.frame = 0
-            self.last_update = t
-        if self.frame >= len(images):
-            self.frame = 0
+    def placed(self):
+        c = self.store.columns
+        c['x'][self.slot], c['y'][self.slot] = self.rect.topleft
+        c['w'][self.slot], c['h'][self.slot] = self.rect.size
+
+    def draw(self):
+        images = self.img
+        ox, oy = self.drawOffset()
         if not self.facingleft:
-            self.image = pygame.transform.flip(images[self.frame],1,0)
-            DISPLAYSURF.blit(self.image, (self.rect.x-15,self.rect.y))
+            self.image = ASSETS.mirrored(images)[self.frame]
+            blit(self.image, (self.rect.x-15+ox,self.rect.y+oy))
         else:
             self.image = images[self.frame]
-            DISPLAYSURF.blit(self.image, (self.rect.x-5,self.rect.y))
+            blit(self.image, (self.rect.x-5+ox,self.rect.y+oy))
         #pygame.draw.rect(DISPLAYSURF, (255,0,0), self.rect, 1)        
 
+    def hitMask(self):
+        if not self.facingleft:
+            return ASSETS.masks(ASSETS.mirrored(self.img))[self.frame], (self.rect.x-15,self.rect.y)
+        return ASSETS.masks(self.img)[self.frame], (self.rect.x-5,self.rect.y)
+
     def update(self):
-        self.draw(pygame.time.get_ticks(),self.img)        
-        self.rect.x += self.dx
-        if self.rect.x > self.max or self.rect.x < self.min:
-            self.facingleft = not self.facingleft
-            self.dx = -self.dx   
+        self.store.step([self])
             
 class Player(Collidable):
 
@@ -183,55 +1515,64 @@ class Player(Collidable):
         self.jump_speed = 0
         self.jump_accel = 4
         self.arm_angle = 0
-        self.img_idle = loadSlicedSprites(TILESIZE,TILESIZE,'img/roxanne_idle.png')
-        self.img_walk = loadSlicedSprites(TILESIZE,TILESIZE,'img/roxanne_walk.png')
-        self.img_jump = loadSlicedSprites(TILESIZE,TILESIZE,'img/roxanne_jump.png')
-        self.img_dead = loadSlicedSprites(TILESIZE,TILESIZE,'img/dead.png')
-        self.masterimg_arm = pygame.image.load('img/roxanne_arm.png')
-        self.masterimg_arm.set_colorkey((255,255,255))
+        self.img_idle = ASSETS.sliced(TILESIZE,TILESIZE,'img/roxanne_idle.png')
+        self.img_walk = ASSETS.sliced(TILESIZE,TILESIZE,'img/roxanne_walk.png')
+        self.img_jump = ASSETS.sliced(TILESIZE,TILESIZE,'img/roxanne_jump.png')
+        self.img_dead = ASSETS.sliced(TILESIZE,TILESIZE,'img/dead.png')
+        self.masterimg_arm = ASSETS.image('img/roxanne_arm.png')
         self.img_arm = self.masterimg_arm
-        self.img_arm.set_colorkey((255,255,255))
-        self.img_crosshair = pygame.image.load('img/crosshair.png')
-        self.img_crosshair.set_colorkey((255,255,255))
+        self.rotations_arm = ASSETS.rotations('img/roxanne_arm.png')
+        self.img_crosshair = ASSETS.image('img/crosshair.png')
         self.img = self.img_idle[0]        
+        self.images = self.img_idle
         self.rect = pygame.Rect(x,y,TILESIZE,TILESIZE)
         self.rect.center = (x,y)
         self.rect = self.rect.inflate(-10,0)
         self.frame = 0
         self.facingleft = False
         self.last_update = 0
+        self.aim = (0,0)
 
-        self.shots = pygame.sprite.Group()
+        self.shots = BulletPool()
         
         self.walking = True
         self.jumping = True
+        self.dying = False
 
         self.maxvelocity = 6
 
         self.color = (255,0,0)
 
-        self.sound_shoot = pygame.mixer.Sound('sound/pew.wav')
-        self.sound_walk = pygame.mixer.Sound('sound/walk.ogg')
         
     def __str__(self):
         return "The main player."
 
-    def draw(self,t,images):
-        if t-self.last_update > 3000/FPS:
-            self.frame += 1
-            if self.frame>=len(images):
-                self.frame = 0
-            self.last_update = t
-        if self.frame >= len(images):
-            self.frame = 0
+    def draw(self,images=None):
+        if images is None:
+            images = self.images
+        frame = self.frame
+        if frame >= len(images):
+            frame = 0
         if not self.facingleft:
-            self.image = pygame.transform.flip(images[self.frame],1,0)
+            self.image = ASSETS.mirrored(images)[frame]
         else:
-            self.image = images[self.frame]
-        DISPLAYSURF.blit(self.image, self.rect.topleft)
-        DISPLAYSURF.blit(self.img_crosshair, (pygame.mouse.get_pos()[0]-20,pygame.mouse.get_pos()[1]-20))
+            self.image = images[frame]
+        ox, oy = self.drawOffset()
+        blit(self.image, (self.rect.x+ox,self.rect.y+oy))
+        blit(self.img_crosshair, (self.aim[0]-20,self.aim[1]-20))
         #pygame.draw.rect(DISPLAYSURF, self.color, self.rect, 1)
 
+    def hitMask(self):
+        #Taken from the animation state, not the last drawn image, so
+        #headless runs hit the same way
+        images = self.images
+        if not self.facingleft:
+            images = ASSETS.mirrored(images)
+        frame = self.frame
+        if frame >= len(images):
+            frame = 0
+        return ASSETS.masks(images)[frame], self.rect.topleft
+
     def onCollision(self, side, sprite):
         self.toSide(sprite, side)
         if side == TOP_SIDE:
@@ -249,42 +1590,57 @@ class Player(Collidable):
     def kill(self):
         pygame.sprite.Sprite.kill(self)
         
-    def sawkill(self,m):
-        start = pygame.time.get_ticks()
-        while pygame.time.get_ticks() - start < 7000/FPS:
-            m.update()
-            self.draw(pygame.time.get_ticks(),self.img_dead)
-            pygame.display.update()
-            FPSCLOCK.tick(FPS)
+    def sawkill(self):
+        if not self.dying:
+            self.dying = True
+            SCHEDULER.spawn(self.die())
+
+    def die(self):
+        start = SIMCLOCK.now
+        while SIMCLOCK.now - start < 7000/FPS:
+            yield
         self.kill()
 
     def shoot(self):
-        if len(self.shots) <= 0:
+        if len(self.shots) <= 0 and not self.swapping and not self.dying:
             #for shot in self.shots:
                 #shot.kill()
             if self.facingleft:
                 #self.shots.add(Bullet(self.rect.x,self.rect.y+20,self.arm_angle,self))
-                self.shots.add(Bullet(self.rect.center[0]+math.cos(self.arm_angle)*20,self.rect.center[1]+math.sin(self.arm_angle)*20,self.arm_angle,self))                
+                self.shots.fire(self.rect.center[0]+math.cos(self.arm_angle)*20,self.rect.center[1]+math.sin(self.arm_angle)*20,self.arm_angle,self)
             else:
                 #self.shots.add(Bullet(self.rect.x+40,self.rect.y+20,self.arm_angle,self))
-                self.shots.add(Bullet(self.rect.center[0]+math.cos(self.arm_angle)*20,self.rect.center[1]-math.sin(self.arm_angle)*20,self.arm_angle,self))                                
-            self.sound_shoot.play()
+                self.shots.fire(self.rect.center[0]+math.cos(self.arm_angle)*20,self.rect.center[1]-math.sin(self.arm_angle)*20,self.arm_angle,self)
+            AUDIO.play('shoot')
             #print math.degrees(self.arm_angle)
                 
     def updateArm(self):
-        self.img_arm = pygame.transform.rotate(self.masterimg_arm, math.degrees(self.arm_angle)+180)
-        if not self.facingleft:
-            self.img_arm = pygame.transform.rotate(self.masterimg_arm, (-1)*math.degrees(self.arm_angle)+180)
-            self.img_arm = pygame.transform.flip(self.img_arm,0,1)            
+        if self.facingleft:
+            self.img_arm = self.rotations_arm.get(math.degrees(self.arm_angle)+180)
+        else:
+            self.img_arm = self.rotations_arm.get((-1)*math.degrees(self.arm_angle)+180, True)
             
-        DISPLAYSURF.blit(self.img_arm, self.rect.topleft)
+        ox, oy = self.drawOffset()
+        blit(self.img_arm, (self.rect.x+ox,self.rect.y+oy))
 
-    def update(self):
+    def update(self,inp=None):
+        if inp is None:
+            inp = InputState.capture()
         self.dx = 0
-        pressed = pygame.key.get_pressed()
-        mouse_pos = pygame.mouse.get_pos()
+        pressed = inp
+        mouse_pos = CAMERA.toWorld(inp.mouse_pos)
+        self.aim = mouse_pos
         self.arm_angle = math.atan2((-1)*(mouse_pos[1]-self.rect.y),(mouse_pos[0]-self.rect.x))
-        self.updateArm()
+
+        if self.dying or self.swapping:
+            #Scheduler tasks own the player until they finish
+            self.shots.update(self.grid, self.collision_groups)
+            if self.dying:
+                self.images = self.img_dead
+            else:
+                self.images = self.img_jump
+            self.animate(SIMCLOCK.now,self.images)
+            return
 
         if pressed[K_UP] or pressed[K_w] or pressed[K_SPACE]:
             self.jump_accel = 0.3
@@ -301,7 +1657,7 @@ class Player(Collidable):
         if pressed[K_LSHIFT]:
             self.dx *= 2
 
-        if pygame.mouse.get_pressed()[0]:
+        if inp.mouse_buttons[0]:
             self.shoot()
             
         if self.jump_speed < 8:
@@ -309,57 +1665,204 @@ class Player(Collidable):
         if self.jump_speed > 3:
             self.jumping = True
 
+        PROFILER.lap('player input')
         self.move(self.dx, self.jump_speed)
-        self.shots.update()
+        PROFILER.lap('player collide')
+        self.shots.update(self.grid, self.collision_groups)
+        PROFILER.lap('bullets')
 
-        if self.rect.y > WINDOWHEIGHT:
+        if self.rect.y > CAMERA.bounds.bottom:
             self.kill()
         
         if self.jumping:
-            self.draw(pygame.time.get_ticks(),self.img_jump)
+            self.images = self.img_jump
         else:
             self.walking = (self.dx!=0)
             if self.walking:
-                self.draw(pygame.time.get_ticks(),self.img_walk)
-                #self.sound_walk.play()
+                self.images = self.img_walk
+                #AUDIO.play('walk')
             else:
-                self.draw(pygame.time.get_ticks(),self.img_idle)
-
-class Bullet(Collidable):
-
-    def __init__(self,x,y,angle, p):
-        Collidable.__init__(self)
-        self.image = pygame.image.load('img/bullet.png')
-        self.image.set_colorkey((255,255,255))
-        self.image = pygame.transform.rotate(self.image, math.degrees(angle)+180)
-        self.rect = self.image.get_rect().inflate(-30,-30)
-        self.rect.center = (x,y)
-        self.degree = angle
-        self.env = p.collision_groups
-
-        self.player = p
+                self.images = self.img_idle
+        self.animate(SIMCLOCK.now,self.images)
+
+def sweepRect(x0, y0, x1, y1, rect):
+    #Fraction along the segment where it enters rect, or None if it misses
+    tmin, tmax = 0.0, 1.0
+    for p0, d, lo, hi in ((x0, x1-x0, rect.left, rect.right), (y0, y1-y0, rect.top, rect.bottom)):
+        if d == 0:
+            if p0 < lo or p0 >= hi:
+                return None
+            continue
+        t0 = (lo-p0)/d
+        t1 = (hi-p0)/d
+        if t0 > t1:
+            t0, t1 = t1, t0
+        tmin = max(tmin, t0)
+        tmax = min(tmax, t1)
+        if tmin > tmax:
+            return None
+    return tmin
+
+class BulletPool(object):
+    def __init__(self, capacity=BULLET_POOL_SIZE):
+        self.capacity = capacity
+        if numpy is not None:
+            self.pos = numpy.zeros((capacity,2))
+            self.prev = numpy.zeros((capacity,2))
+            self.vel = numpy.zeros((capacity,2))
+            self.alive = numpy.zeros(capacity, bool)
+        else:
+            self.pos = [[0.0,0.0] for i in range(capacity)]
+            self.prev = [[0.0,0.0] for i in range(capacity)]
+            self.vel = [[0.0,0.0] for i in range(capacity)]
+            self.alive = [False]*capacity
+        self.images = [None]*capacity
+        self.masks = [None]*capacity
+        self.owners = [None]*capacity
+        self.free = range(capacity-1, -1, -1)
+        self.count = 0
+        self.rotations = ASSETS.rotations('img/bullet.png')
 
     def __str__(self):
-        return "A projectile that will kill itself upon collision."
+        return "Preallocated projectiles that kill themselves upon collision."
+
+    def __len__(self):
+        return self.count
+
+    def fire(self, x, y, angle, owner, speed=BULLET_SPEED):
+        if not self.free:
+            return None
+        i = self.free.pop()
+        self.pos[i][0] = self.prev[i][0] = x
+        self.pos[i][1] = self.prev[i][1] = y
+        self.vel[i][0] = speed*math.cos(angle)
+        self.vel[i][1] = -speed*math.sin(angle)
+        self.alive[i] = True
+        self.images[i] = self.rotations.get(math.degrees(angle)+180)
+        self.masks[i] = self.rotations.mask(math.degrees(angle)+180)
+        self.owners[i] = owner
+        self.count += 1
+        return i
+
+    def kill(self, i):
+        if self.alive[i]:
+            self.alive[i] = False
+            self.owners[i] = None
+            self.free.append(i)
+            self.count -= 1
+
+    def clear(self):
+        for i in self.live():
+            self.kill(i)
+
+    def snapshot(self):
+        if numpy is not None:
+            arrays = (self.pos.copy(), self.prev.copy(), self.vel.copy(), self.alive.copy())
+        else:
+            arrays = ([list(p) for p in self.pos], [list(p) for p in self.prev],
+                      [list(v) for v in self.vel], list(self.alive))
+        return arrays + (list(self.images), list(self.masks), list(self.owners), list(self.free), self.count)
+
+    def restore(self, state):
+        pos, prev, vel, alive, images, masks, owners, free, count = state
+        if numpy is not None:
+            self.pos[:], self.prev[:], self.vel[:], self.alive[:] = pos, prev, vel, alive
+        else:
+            self.pos = [list(p) for p in pos]
+            self.prev = [list(p) for p in prev]
+            self.vel = [list(v) for v in vel]
+            self.alive = list(alive)
+        self.images, self.masks, self.owners, self.free = list(images), list(masks), list(owners), list(free)
+        self.count = count
+
+    def live(self):
+        if numpy is not None:
+            return [int(i) for i in numpy.flatnonzero(self.alive)]
+        return [i for i in range(self.capacity) if self.alive[i]]
+
+    def advance(self):
+        #Moves every live projectile one tick and drops the ones off screen
+        view = CAMERA.rect
+        if numpy is not None:
+            live = numpy.flatnonzero(self.alive)
+            self.prev[live] = self.pos[live]
+            self.pos[live] += self.vel[live]
+            p = self.pos[live]
+            out = (p[:,0] > view.right) | (p[:,0] < view.left) | (p[:,1] > view.bottom) | (p[:,1] < view.top)
+            for i in live[out]:
+                self.kill(int(i))
+            return [int(i) for i in live[~out]]
+        live = []
+        for i in range(self.capacity):
+            if self.alive[i]:
+                self.prev[i][:] = self.pos[i]
+                self.pos[i][0] += self.vel[i][0]
+                self.pos[i][1] += self.vel[i][1]
+                x, y = self.pos[i]
+                if x > view.right or x < view.left or y > view.bottom or y < view.top:
+                    self.kill(i)
+                else:
+                    live.append(i)
+        return live
+
+    def corner(self, (w,h), x, y):
+        #Drawn a little behind the hit point, as the old Bullet sprite was
+        return int(x)-w/2-5, int(y)-h/2
+
+    def firstHit(self, i, grid, groups):
+        x0, y0 = float(self.prev[i][0]), float(self.prev[i][1])
+        x1, y1 = float(self.pos[i][0]), float(self.pos[i][1])
+        mask = self.masks[i]
+        w, h = mask.get_size()
+        #Broad phase on the rects the drawn bullet sweeps through, then its
+        #mask is stepped along the path no more than BULLET_RADIUS at a time
+        left, top = self.corner((w,h), min(x0,x1), min(y0,y1))
+        swept = pygame.Rect(left, top, abs(x1-x0)+w+1, abs(y1-y0)+h+1)
+        if grid is not None:
+            candidates = grid.query(swept)
+        else:
+            candidates = [obj for group in groups for obj in group]
+        PROFILER.count('collision tests', len(candidates))
+        steps = max(1, int(math.ceil(math.hypot(x1-x0, y1-y0)/BULLET_RADIUS)))
+        best, hit = None, None
+        for obj in candidates:
+            if not obj.rect.colliderect(swept):
+                continue
+            for group in groups:
+                if obj in group:
+                    #Where the bullet's bounds first reach the rect
+                    reach = pygame.Rect(obj.rect.left-w+w/2+5, obj.rect.top-h+h/2, obj.rect.w+w, obj.rect.h+h)
+                    t = sweepRect(x0, y0, x1, y1, reach)
+                    if t is None or (best is not None and t >= best):
+                        break
+                    objmask, (ox, oy) = obj.hitMask()
+                    for k in [t] + [float(j)/steps for j in range(steps+1) if float(j)/steps > t]:
+                        if best is not None and k >= best:
+                            break
+                        cx, cy = self.corner((w,h), x0+(x1-x0)*k, y0+(y1-y0)*k)
+                        if objmask.overlap(mask, (cx-ox, cy-oy)) is not None:
+                            best, hit = k, obj
+                            break
+                    break
+        return hit
+
+    def update(self, grid, groups):
+        if not self.count:
+            return
+        for i in self.advance():
+            hit = self.firstHit(i, grid, groups)
+            if hit is not None:
+                owner = self.owners[i]
+                self.kill(i)
+                hit.onShot(owner)
 
     def draw(self):
-        DISPLAYSURF.blit(self.image, (self.rect.x-20,self.rect.y-15))
-        #DISPLAYSURF.blit(self.image, (self.rect.x,self.rect.y))
-        #pygame.draw.rect(DISPLAYSURF, (255,0,0), self.rect, 3)
-
-    def update(self):
-        self.rect.x += 20*math.cos(self.degree)
-        self.rect.y -= 20*math.sin(self.degree)
-        if self.rect.x > WINDOWWIDTH or self.rect.x < 0 or self.rect.y > WINDOWHEIGHT or self.rect.y < 0:
-            self.kill()
-        for group in self.env:
-            for spr in pygame.sprite.spritecollide(self,group,False):
-                if str(type(spr)) == "<class '__main__.Platform'>":
-                    self.kill()
-                if (str(type(spr)) == "<class '__main__.Switch'>") or (str(type(spr)) == "<class '__main__.MovingSwitch'>"):
-                    self.kill()
-                    spr.switch(self.player)
-        self.draw()
+        t = 1.0 - SIMCLOCK.alpha
+        for i in self.live():
+            img = self.images[i]
+            x = self.pos[i][0] + (self.prev[i][0]-self.pos[i][0])*t
+            y = self.pos[i][1] + (self.prev[i][1]-self.pos[i][1])*t
+            blit(img, self.corner(img.get_size(), x, y))
 
 class Platform(Collidable):
     
@@ -368,8 +1871,7 @@ class Platform(Collidable):
         self.x = x
         self.y = y
         filepath = 'img/platform' + str(n) + '.png'
-        self.image = pygame.image.load(filepath)
-        self.image.set_colorkey((255,255,255))
+        self.image = ASSETS.image(filepath)
         self.rect = self.image.get_rect()
         self.rect.center = (self.x,self.y)
         
@@ -377,10 +1879,7 @@ class Platform(Collidable):
         return "Immovable platform."
 
     def draw(self):
-        DISPLAYSURF.blit(self.image, self.rect.topleft)
-        
-    def update(self):
-        self.draw()
+        DISPLAYSURF.blit(self.image, CAMERA.toScreen(self.rect.topleft))
 
 class Switch(Collidable):
 
@@ -388,10 +1887,8 @@ class Switch(Collidable):
         Collidable.__init__(self)
         self.x = x
         self.y = y
-        self.falseimage = pygame.image.load('img/switch1.png')
-        self.falseimage.set_colorkey((255,255,255))
-        self.trueimage = pygame.image.load('img/switch2.png')
-        self.trueimage.set_colorkey((255,255,255))
+        self.falseimage = ASSETS.image('img/switch1.png')
+        self.trueimage = ASSETS.image('img/switch2.png')
         self.image = self.trueimage
         self.rect = self.image.get_rect()
         self.rect.center = (self.x,self.y)
@@ -402,48 +1899,61 @@ class Switch(Collidable):
         return "Toggled switch returns TRUE/FALSE"
 
     def switch(self,spr):
-        x1 = self.rect.center[0]
-        y1 = self.rect.center[1]
-        x2 = spr.rect.center[0]
-        y2 = spr.rect.center[1]
-
-        x1n = x1
-        y1n = y1
-        x2n = x2
-        y2n = y2
-
-        dx = (x2-x1)/10
-        dy = (y2-y1)/10
-
-        for i in range(10):
-            x1n += dx
-            x2n -= dx
-            y1n += dy
-            y2n -= dy
-            self.rect.center = (x1n, y1n)
-            spr.rect.center = (x2n, y2n)
-            self.draw()
-            spr.draw(pygame.time.get_ticks(),spr.img_jump)
-            pygame.display.update()
-            FPSCLOCK.tick(FPS)
-
-        self.rect.center = (x2, y2)
-        spr.rect.center = (x1, y1)
+        if not self.swapping and not spr.swapping:
+            SCHEDULER.spawn(self.swap(spr))
+
+    def swap(self,spr):
+        #Both sides are frozen while they slide past each other
+        x1, y1 = self.rect.center
+        x2, y2 = spr.rect.center
+        self.swapping = spr.swapping = True
+
+        def step(t):
+            self.rect.center = (x1+int((x2-x1)*t), y1+int((y2-y1)*t))
+            spr.rect.center = (x2+int((x1-x2)*t), y2+int((y1-y2)*t))
+            self.reindex()
+
+        for frame in tween(10, step):
+            yield
         self.x = x2
         self.y = y2
+        self.swapping = spr.swapping = False
+        self.swapped()
+
+    def swapped(self):
+        pass
+
+    def onShot(self,shooter):
+        self.switch(shooter)
+
+    def hitMask(self):
+        if self.on:
+            return ASSETS.mask(self.trueimage), self.rect.topleft
+        return ASSETS.mask(self.falseimage), self.rect.topleft
 
     def draw(self):
         self.image = self.falseimage
         if self.on:
             self.image = self.trueimage
-        DISPLAYSURF.blit(self.image,self.rect.topleft)
-
-    def update(self):
-        self.draw()
+        ox, oy = self.drawOffset()
+        blit(self.image,(self.rect.x+ox,self.rect.y+oy))
 
 class MovingSwitch(Switch):
-    def __init__(self,x,y,dx=3,dy=0,xmax=200,ymax=120):
+    x = StoreField('x')
+    y = StoreField('y')
+    dx = StoreField('dx')
+    dy = StoreField('dy')
+    midx = StoreField('midx')
+    midy = StoreField('midy')
+    xmax = StoreField('xmax')
+    ymax = StoreField('ymax')
+
+    def __init__(self,x,y,dx=3,dy=0,xmax=200,ymax=120,store=None):
+        if store is None:
+            store = SwitchStore(1)
+        store.attach(self)
         Switch.__init__(self,x,y)
+        self.placed()
         self.dx = dx
         self.dy = dy
         self.midx = x
@@ -451,23 +1961,21 @@ class MovingSwitch(Switch):
         self.xmax = xmax
         self.ymax = ymax
 
+    def placed(self):
+        self.x, self.y = self.rect.center
+        c = self.store.columns
+        c['w'][self.slot], c['h'][self.slot] = self.rect.size
+
     def move(self):
-        self.x += self.dx
-        self.y += self.dy
-        if self.x > self.midx + self.xmax or self.x < self.midx - self.xmax:
-            self.dx = -self.dx
-        if self.y > self.midy + self.ymax or self.y < self.midy - self.ymax:
-            self.dy = -self.dy
-        self.rect.center = (self.x,self.y)
+        self.store.step([self])
 
-    def switch(self,spr):
-        Switch.switch(self,spr)
+    def swapped(self):
         self.midx = self.x
         self.midy = self.y
         
     def update(self):
-        self.move()
-        self.draw()
+        if not self.swapping:
+            self.move()
         
         
 class Map(object):
@@ -476,25 +1984,29 @@ class Map(object):
         self.platforms = pygame.sprite.Group()
         self.switches = pygame.sprite.Group()
         self.enemies = pygame.sprite.Group()
+        self.saws = SawStore()
+        self.movers = SwitchStore()
+        self.grid = SpatialGrid(TILESIZE)
+        self.actors = SpatialGrid(CHUNKSIZE*TILESIZE)
+        self.active = []
+        self.prebaked = PREBAKE_TILES
+        self.layout = list(key)
+        self.spawned = {}
+        self.loaded = {}
+        self.chunks = {}
+        self.bounds = pygame.Rect(0,0,0,0)
         self.entrance = (0,0)
         self.exit = pygame.Rect(0,0,TILESIZE,TILESIZE)
-        self.img_exit = loadSlicedSprites(40, 40, 'img/exitgate.png')
+        self.img_exit = ASSETS.sliced(40, 40, 'img/exitgate.png')
         self.frame = 0
-        self.last_update = pygame.time.get_ticks()
+        #Levels may be built while another one is running; each starts its
+        #own clock at zero in Level.start()
+        self.last_update = 0
         self.populate(key,enemykey)
 
         ########
 
-        self.img_cloud1 = pygame.image.load('img/menu_cloud1.png')
-        self.img_cloud2 = pygame.image.load('img/menu_cloud2.png')
-        self.img_cloud3 = pygame.image.load('img/menu_cloud3.png')
-
-        self.img_citybg = pygame.image.load('img/city_bg.png')
-
-        self.img_cloud1.set_colorkey((255,255,255))
-        self.img_cloud2.set_colorkey((255,255,255))
-        self.img_cloud3.set_colorkey((255,255,255))
-        self.img_citybg.set_colorkey((255,255,255))
+        self.background = ASSETS.parallax(LEVEL_LAYERS)
 
         self.x = 800            
 
@@ -507,28 +2019,174 @@ class Map(object):
         #E - Exit
         #2 - Up/Left Corner Tile
         #S - Switch
-        
-        x=TILESIZE/2
+
+        #Platforms are left to loadChunk(); only the few moving parts and
+        #the level bounds are taken from the whole layout up front
+        self.markers(layout)
+        for cell, spawn in sorted(levelSpawns(layout,enemy_params).items(), key=lambda (c, s): (c[1], c[0])):
+            self.spawn(cell,spawn)
+
+    def markers(self,layout):
         y=TILESIZE/2
-        e_count = 0
+        extent = []
         for row in layout:
-            x = TILESIZE/2
-            for col in row:
-                if isNumber(col):
-                    self.platforms.add(Platform(x,y,col))
-                if col == "Q":
-                    self.entrance = (x,y)
-                if col == "E":
-                    self.exit.center = (x,y)
-                if col == "S":
-                    self.switches.add(Switch(x,y))
-                if col == "M":
-                    self.switches.add(MovingSwitch(x,y))
-                if col == "V" and len(enemy_params)>e_count:
-                    self.enemies.add(Enemy((x,y),enemy_params[e_count]))
-                    e_count += 1
-                x += TILESIZE
+            if row.strip():
+                extent.append(pygame.Rect(0, y-TILESIZE/2, len(row.rstrip())*TILESIZE, TILESIZE))
+            if "Q" in row:
+                self.entrance = (TILESIZE/2+row.rindex("Q")*TILESIZE,y)
+            if "E" in row:
+                self.exit.center = (TILESIZE/2+row.rindex("E")*TILESIZE,y)
             y += TILESIZE
+        if extent:
+            self.bounds = extent[0].unionall(extent[1:])
+
+    def spawn(self,(col,row),(tile,params)):
+        x = TILESIZE/2+col*TILESIZE
+        y = TILESIZE/2+row*TILESIZE
+        if tile == "S":
+            spr = Switch(x,y)
+            self.place(self.switches, spr)
+        elif tile == "M":
+            spr = MovingSwitch(x,y,store=self.movers)
+            self.place(self.switches, spr)
+        else:
+            spr = Enemy((x,y),params,self.saws)
+            self.place(self.enemies, spr)
+        self.spawned[col,row] = (tile,params), spr
+
+    def despawn(self,cell):
+        spawn, spr = self.spawned.pop(cell)
+        spr.kill()
+        self.grid.remove(spr)
+        self.actors.remove(spr)
+        if spr.store is not None:
+            spr.store.detach(spr)
+
+    def reload(self,layout,enemy_params):
+        #Only the tiles and moving parts that differ are rebuilt, along with
+        #the baked chunks under changed tiles
+        rebake = set()
+        for row in range(max(len(layout), len(self.layout))):
+            old = self.layout[row] if row < len(self.layout) else ''
+            new = layout[row] if row < len(layout) else ''
+            if old == new:
+                continue
+            for col in range(max(len(old), len(new))):
+                a = old[col] if col < len(old) else ' '
+                b = new[col] if col < len(new) else ' '
+                if a != b and (a.isdigit() or b.isdigit()):
+                    key = self.replaceTile(col,row,b)
+                    if key is not None:
+                        rebake.add(key)
+        self.layout = list(layout)
+        if self.prebaked:
+            for key in rebake:
+                self.bakeChunk(key)
+        spawns = levelSpawns(layout,enemy_params)
+        for cell in self.spawned.keys():
+            if spawns.get(cell) != self.spawned[cell][0]:
+                self.despawn(cell)
+        for cell, spawn in sorted(spawns.items(), key=lambda (c, s): (c[1], c[0])):
+            if cell not in self.spawned:
+                self.spawn(cell,spawn)
+        self.active = [spr for spr in self.active if spr.alive()]
+        #Entrance, exit and bounds are cheap enough to take again
+        self.markers(layout)
+
+    def replaceTile(self,col,row,tile):
+        #Swaps the Platform of one cell in a loaded chunk and returns the
+        #chunk, which then needs baking again
+        key = (col/CHUNKSIZE, row/CHUNKSIZE)
+        if key not in self.loaded:
+            return None
+        plats = self.loaded[key]
+        topleft = (col*TILESIZE, row*TILESIZE)
+        for plat in [p for p in plats if p.rect.topleft == topleft]:
+            plats.remove(plat)
+            plat.kill()
+            self.grid.remove(plat)
+        if tile.isdigit():
+            plat = Platform(TILESIZE/2+col*TILESIZE, TILESIZE/2+row*TILESIZE, tile)
+            self.place(self.platforms, plat)
+            plats.append(plat)
+        return key
+
+    def place(self,group,spr):
+        group.add(spr)
+        self.grid.add(spr)
+        spr.grid = self.grid
+        if group is not self.platforms:
+            self.actors.add(spr)
+            spr.actors = self.actors
+
+    def loadChunk(self,key):
+        plats = self.loaded[key] = []
+        for row in range(max(key[1]*CHUNKSIZE,0), min((key[1]+1)*CHUNKSIZE, len(self.layout))):
+            line = self.layout[row]
+            for col in range(max(key[0]*CHUNKSIZE,0), min((key[0]+1)*CHUNKSIZE, len(line))):
+                if line[col].isdigit():
+                    plat = Platform(TILESIZE/2+col*TILESIZE, TILESIZE/2+row*TILESIZE, line[col])
+                    self.place(self.platforms, plat)
+                    plats.append(plat)
+        if plats and self.prebaked:
+            self.bakeChunk(key)
+
+    def unloadChunk(self,key):
+        for plat in self.loaded.pop(key):
+            plat.kill()
+            self.grid.remove(plat)
+        self.chunks.pop(key, None)
+
+    def stream(self,view):
+        size = CHUNKSIZE*TILESIZE
+        wanted = cellsCovering(view.inflate(2*STREAM_MARGIN, 2*STREAM_MARGIN), size)
+        for key in wanted:
+            if key not in self.loaded:
+                self.loadChunk(key)
+        if len(self.loaded) > len(wanted):
+            keep = set(cellsCovering(view.inflate(4*STREAM_MARGIN, 4*STREAM_MARGIN), size))
+            for key in self.loaded.keys():
+                if key not in keep:
+                    self.unloadChunk(key)
+
+    def setTile(self,col,row,tile):
+        #Platform edits go to the layout, so they survive the chunk unloading
+        while len(self.layout) <= row:
+            self.layout.append('')
+        line = self.layout[row].ljust(col+1)
+        self.layout[row] = line[:col] + tile + line[col+1:]
+        key = self.replaceTile(col,row,tile)
+        if key is not None and self.prebaked:
+            self.bakeChunk(key)
+
+    def bakeChunk(self,key):
+        size = CHUNKSIZE*TILESIZE
+        area = pygame.Rect(key[0]*size, key[1]*size, size, size)
+        tiles = [p for p in self.grid.query(area) if p in self.platforms]
+        if not tiles:
+            self.chunks.pop(key, None)
+            return
+        surf = pygame.Surface(area.size)
+        if pygame.display.get_surface() is not None:
+            surf = surf.convert()
+        surf.fill(CHUNK_COLORKEY)
+        for plat in tiles:
+            surf.blit(plat.image, (plat.rect.x-area.x, plat.rect.y-area.y))
+        surf.set_colorkey(CHUNK_COLORKEY, RLEACCEL)
+        self.chunks[key] = surf
+
+    def drawTiles(self):
+        view = CAMERA.view()
+        if not self.prebaked:
+            for plat in self.grid.query(view):
+                if plat in self.platforms:
+                    plat.draw()
+            return
+        size = CHUNKSIZE*TILESIZE
+        for key in cellsCovering(view, size):
+            surf = self.chunks.get(key)
+            if surf is not None:
+                DISPLAYSURF.blit(surf, CAMERA.toScreen((key[0]*size, key[1]*size)))
 
     def isExiting(self,playerRect):
         if self.exit.inflate(-40,-40).colliderect(playerRect):
@@ -536,116 +2194,561 @@ class Map(object):
         return False
 
     def displaybg(self):
-        DISPLAYSURF.fill((46,48,151))
-
-        DISPLAYSURF.blit(self.img_cloud1, (800-self.x,0))
-        DISPLAYSURF.blit(self.img_cloud1, (0-self.x,0))
-        DISPLAYSURF.blit(self.img_citybg, (0,0))
-        for i in range(3):
-            DISPLAYSURF.blit(self.img_cloud2, (i*800-self.x*2,0))
+        self.background.draw(self.x)
         
-        #for i in range(6):
-        #    DISPLAYSURF.blit(self.img_cloud3, (i*800-self.x*4,0))
-
+    def update(self):
         self.x -= 1
         if self.x < 0:
             self.x = 800          
-        
-    def update(self):
-        self.displaybg()
 
-        if pygame.time.get_ticks()-self.last_update > 3000/FPS:
+        if SIMCLOCK.now-self.last_update > 3000/FPS:
             self.frame += 1
             if self.frame>=len(self.img_exit):
                 self.frame = 0
-            self.last_update = pygame.time.get_ticks()        
-        DISPLAYSURF.blit(self.img_exit[self.frame], self.exit.topleft)
-        self.platforms.update()
-        self.switches.update()
-        self.enemies.update()
+            self.last_update = SIMCLOCK.now
+        near = self.actors.query(CAMERA.rect.inflate(2*ACTIVE_MARGIN, 2*ACTIVE_MARGIN))
+        #Sorted by store rather than by group, which is a lot cheaper to ask
+        movers = [spr for spr in near if spr.store is self.movers]
+        saws = [spr for spr in near if spr.store is self.saws]
+        self.active = [spr for spr in near if spr.store is None and spr in self.switches] + movers + saws
+        #One batched step per kind; anything else that moved reindexed itself
+        self.movers.step([spr for spr in movers if not spr.swapping])
+        self.saws.step(saws)
+
+    def draw(self):
+        self.displaybg()
+        PROFILER.lap('background')
+        blit(self.img_exit[self.frame], self.exit.topleft)
+        self.drawTiles()
+        PROFILER.lap('tiles')
+        for spr in self.active:
+            spr.draw()
+        PROFILER.lap('map sprites')
 
       
     
-def runLevel(n):
-    global GAMESTATE
-
+class LevelError(Exception):
+    pass
+
+def levelSources(n):
+    return 'map/' + str(n) + '.txt', 'map/enemies/' + str(n) + '.txt'
+
+def levelSpawns(maptxt, enemytxt):
+    #Where each switch and saw starts, as {(col,row): (tile, patrol)}. Saws
+    #take patrols in reading order; any past the last patrol are left out
+    spawns = {}
+    e_count = 0
+    for row, line in enumerate(maptxt):
+        if 'S' not in line and 'M' not in line and 'V' not in line:
+            continue
+        for col, tile in enumerate(line):
+            if tile in 'SM':
+                spawns[col,row] = (tile, None)
+            if tile == 'V' and len(enemytxt) > e_count:
+                spawns[col,row] = (tile, tuple(enemytxt[e_count]))
+                e_count += 1
+    return spawns
+
+def loadLevelText(n):
+    mappath, enemypath = levelSources(n)
     maptxt = []
-    mapfile = open('map/' + str(n) + '.txt', 'r')
-    line = None
-    while line != '':
-        line = mapfile.readline().translate(None, '\n')
-        maptxt.append(line)
+    mapfile = open(mappath, 'r')
+    for line in mapfile:
+        maptxt.append(line.rstrip('\r\n'))
     mapfile.close()
 
     enemytxt = []
-    try:
-        enemyfile = open('map/enemies/' + str(n) + '.txt', 'r')
-        line = None
-        while line != '':
-            line = enemyfile.readline().translate(None, '\n')
-            if line!= '':
-                coords = line.split(',')
-                enemytxt.append((coords[0],coords[1]))
+    if os.path.exists(enemypath):
+        enemyfile = open(enemypath, 'r')
+        for i, line in enumerate(enemyfile):
+            line = line.strip()
+            if line == '':
+                continue
+            coords = line.split(',')
+            if len(coords) != 2 or not coords[0].strip().isdigit() or not coords[1].strip().isdigit():
+                raise LevelError('%s:%d: expected "left,right" patrol distances, got %r' % (enemypath, i+1, line))
+            enemytxt.append((int(coords[0]),int(coords[1])))
         enemyfile.close()
-    except:
-        pass
-    
-    level_map = Map(maptxt,enemytxt)    
-    player = Player(level_map.entrance)
-    player_group = pygame.sprite.Group()
-    text_group = pygame.sprite.Group()
-    player_group.add(player)
-    player.collidesWith(level_map.platforms)
-    player.collidesWith(level_map.switches)
-    #player.collidesWith(level_map.enemies)
-
-    ###Tutorial Bubbles
-    txt = ''
-    if n == 1:
-        txt = "I can use the W A and D keys to move. [Press S]"
-    if n == 3:
-        txt = "I can also shoot targets with the mouse."
-    if n == 4:
-        txt = "If I get stuck, I can press R to restart the level."
-    if n == 6:
-        txt = "Swapping conserves momentum."
-    if n == 14:
-        txt = "Better not touch those saws..."
-    if txt != '':
-        s = SpeechBubble(player.rect.x+50,player.rect.y-60,txt)
-        text_group.add(s)
-    
-    while (not level_map.isExiting(player.rect)) and (player_group):
-        for event in pygame.event.get():
-            if event.type == QUIT:
-                terminate()
-            pressed = pygame.key.get_pressed()
-            if pressed[K_ESCAPE]:
-                GAMESTATE = MENU
-                player_group.empty()
-            if pressed[K_r]:
-                player_group.empty()
-            if pressed[K_s]:
-                for bubble in text_group:
-                    bubble.next_msg()
-        level_map.update()                
-        player.update()
-        text_group.update(player.rect.x+50,player.rect.y-60)
-        if pygame.sprite.spritecollide(player,level_map.enemies,False):
-            player.sawkill(level_map)        
-        pygame.display.update()
-        FPSCLOCK.tick(FPS)
-        
-    if (player_group):
+    return maptxt, enemytxt
+
+def validateLevel(n, maptxt, enemytxt):
+    mappath = levelSources(n)[0]
+    counts = {'Q': 0, 'E': 0}
+    for y, row in enumerate(maptxt):
+        for x, col in enumerate(row):
+            if col not in LEVEL_TILES:
+                raise LevelError('%s:%d:%d: unknown tile %r' % (mappath, y+1, x+1, col))
+            if col.isdigit() and not os.path.exists('img/platform' + col + '.png'):
+                raise LevelError('%s:%d:%d: no image for platform %s' % (mappath, y+1, x+1, col))
+            if col in counts:
+                counts[col] += 1
+    for key in ('Q', 'E'):
+        if counts[key] != 1:
+            raise LevelError('%s: expected exactly one %s, found %d' % (mappath, key, counts[key]))
+
+def compileLevel(n, path=None):
+    maptxt, enemytxt = loadLevelText(n)
+    validateLevel(n, maptxt, enemytxt)
+    if path is None:
+        path = compiledLevelPath(n)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    #Written aside and renamed so a half-written file is never loaded
+    out = open(path + '.tmp', 'wb')
+    out.write(packLevel(maptxt, enemytxt))
+    out.close()
+    os.rename(path + '.tmp', path)
+    return path
+
+def packLevel(maptxt, enemytxt):
+    width = max([len(row) for row in maptxt] + [0])
+    data = [struct.pack('<4sBHHH', LEVEL_MAGIC, LEVEL_VERSION, width, len(maptxt), len(enemytxt))]
+    for row in maptxt:
+        data.append(row.ljust(width))
+    for left, right in enemytxt:
+        data.append(struct.pack('<HH', left, right))
+    return ''.join(data)
+
+def compiledLevelPath(n):
+    return os.path.join(LEVEL_BUILD_DIR, str(n) + '.lvl')
+
+def levelIsStale(n):
+    path = compiledLevelPath(n)
+    if not os.path.exists(path):
         return True
+    built = os.path.getmtime(path)
+    for source in levelSources(n):
+        if os.path.exists(source) and os.path.getmtime(source) > built:
+            return True
     return False
 
+def readCompiledLevel(path):
+    f = open(path, 'rb')
+    try:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+    try:
+        maptxt, enemytxt, end = unpackLevel(buf, 0, path)
+        if end != len(buf):
+            raise LevelError('%s: size does not match header' % path)
+    finally:
+        buf.close()
+    return maptxt, enemytxt
+
+def unpackLevel(buf, offset, path):
+    header = struct.calcsize('<4sBHHH')
+    if len(buf) < offset + header:
+        raise LevelError('%s: truncated header' % path)
+    magic, version, width, height, count = struct.unpack_from('<4sBHHH', buf, offset)
+    if magic != LEVEL_MAGIC or version != LEVEL_VERSION:
+        raise LevelError('%s: not a version %d level file' % (path, LEVEL_VERSION))
+    start = offset + header
+    end = start + width*height + count*4
+    if len(buf) < end:
+        raise LevelError('%s: size does not match header' % path)
+    maptxt = [buf[start+y*width:start+(y+1)*width] for y in range(height)]
+    offset = start + width*height
+    enemytxt = [struct.unpack_from('<HH', buf, offset+i*4) for i in range(count)]
+    return maptxt, enemytxt, end
+
+def readLevelPack(path):
+    #Packs are compiled levels back to back, as written by generate.py;
+    #levels are yielded one at a time so a pack is never held decoded
+    f = open(path, 'rb')
+    try:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+    try:
+        offset = 0
+        while offset < len(buf):
+            maptxt, enemytxt, offset = unpackLevel(buf, offset, path)
+            yield maptxt, enemytxt
+    finally:
+        buf.close()
+
+LEVELCACHE = {}
+#Held while compiling or caching, since PREFETCH workers load levels too
+LEVELLOCK = threading.Lock()
+
+def loadCompiledLevel(n):
+    LEVELLOCK.acquire()
+    try:
+        if levelIsStale(n):
+            compileLevel(n)
+        path = compiledLevelPath(n)
+        mtime = os.path.getmtime(path)
+        cached = LEVELCACHE.get(path)
+        if cached is None or cached[0] != mtime:
+            cached = LEVELCACHE[path] = (mtime, readCompiledLevel(path))
+        return cached[1]
+    finally:
+        LEVELLOCK.release()
+
+#Player attributes a snapshot keeps; the rect and shots are saved apart
+PLAYER_STATE = ('dx', 'jump_speed', 'jump_accel', 'jumping', 'walking', 'facingleft', 'frame',
+                'last_update', 'arm_angle', 'aim', 'images', 'dying')
+
+class Level(object):
+    def __init__(self,n,maptxt=None,enemytxt=None):
+        if maptxt is None:
+            maptxt, enemytxt = loadCompiledLevel(n)
+        self.n = n
+        self.map = Map(maptxt,enemytxt)
+        self.player = Player(self.map.entrance)
+        self.player_group = pygame.sprite.Group()
+        self.text_group = pygame.sprite.Group()
+        self.player_group.add(self.player)
+        self.player.grid = self.map.grid
+        self.player.collidesWith(self.map.platforms)
+        self.player.collidesWith(self.map.switches)
+        #self.player.collidesWith(self.map.enemies)
+        self.camera = Camera()
+        self.camera.reset(self.map.bounds, self.player.rect.center)
+        self.map.stream(self.camera.rect)
+        self.ticks = 0
+        self.quit = False
+        self.fade = 0
+
+        ###Tutorial Bubbles
+        txt = ''
+        if n == 1:
+            txt = "I can use the W A and D keys to move. [Press S]"
+        if n == 3:
+            txt = "I can also shoot targets with the mouse."
+        if n == 4:
+            txt = "If I get stuck, I can press R to restart the level."
+        if n == 6:
+            txt = "Swapping conserves momentum."
+        if n == 14:
+            txt = "Better not touch those saws..."
+        if txt != '':
+            s = SpeechBubble(self.player.rect.x+50,self.player.rect.y-60,txt)
+            self.text_group.add(s)
+        self.bubbles = self.text_group.sprites()
+        #Restarts rewind to this instead of building the level again
+        self.initial = self.snapshot()
+
+    def __str__(self):
+        return "One playthrough of a level: map, player and speech bubbles."
+
+    def start(self):
+        #Makes this the level being played; construction may happen elsewhere
+        global CAMERA
+        CAMERA = self.camera
+        SCHEDULER.clear()
+        #Animations, and so saw masks, are timed from the level's own ticks
+        SIMCLOCK.reset(self.ticks)
+
+    def done(self):
+        return self.map.isExiting(self.player.rect) or not self.player_group
+
+    def snapshot(self):
+        #Everything update() changes; platforms, images and the grids are
+        #rebuilt from these rather than saved
+        player = self.player
+        statics = [spr for spr in self.map.switches if spr.store is None]
+        return {'player': (tuple(player.rect), dict([(name, getattr(player, name)) for name in PLAYER_STATE])),
+                'alive': bool(self.player_group),
+                'shots': player.shots.snapshot(),
+                'switches': [(spr, tuple(spr.rect), spr.x, spr.y) for spr in statics],
+                'saws': self.map.saws.snapshot(),
+                'movers': self.map.movers.snapshot(),
+                'bubbles': [(bubble, (bubble.x, bubble.y, bubble.count)) for bubble in self.bubbles
+                            if bubble.alive()],
+                'camera': (tuple(self.camera.rect), self.camera.prev, self.camera.offset),
+                'map': (self.map.frame, self.map.last_update, self.map.x),
+                'ticks': self.ticks}
+
+    def restore(self, snap):
+        SCHEDULER.clear()
+        player = self.player
+        rect, fields = snap['player']
+        player.rect = pygame.Rect(rect)
+        for name, value in fields.items():
+            setattr(player, name, value)
+        player.swapping = False
+        player.shots.restore(snap['shots'])
+        if snap['alive']:
+            self.player_group.add(player)
+        else:
+            self.player_group.empty()
+        for spr, rect, x, y in snap['switches']:
+            spr.rect = pygame.Rect(rect)
+            spr.x, spr.y = x, y
+            spr.swapping = False
+            spr.reindex()
+        self.map.saws.restore(snap['saws'])
+        self.map.movers.restore(snap['movers'])
+        self.text_group.empty()
+        for bubble, state in snap['bubbles']:
+            bubble.rewind(state)
+            self.text_group.add(bubble)
+        rect, self.camera.prev, self.camera.offset = snap['camera']
+        self.camera.rect = pygame.Rect(rect)
+        self.map.stream(self.camera.rect)
+        self.map.frame, self.map.last_update, self.map.x = snap['map']
+        #The clock reads the level's ticks while it runs, so rewinding the
+        #ticks rewinds it too; the snapshot taken in __init__ may not have
+        #been taken on this level's clock
+        self.ticks = snap['ticks']
+        SIMCLOCK.reset(self.ticks)
+        self.quit = False
+        self.fade = 0
+        self.savePositions()
+        DIRTY.markAll()
+
+    def restart(self):
+        self.restore(self.initial)
+
+    def reload(self,maptxt,enemytxt):
+        #The map is diffed at its starting positions so the restart snapshot
+        #can be taken again; the player carries on from where they were
+        now = self.snapshot()
+        self.restore(self.initial)
+        self.map.reload(maptxt,enemytxt)
+        x, y = self.map.entrance
+        self.player.rect = pygame.Rect(x-TILESIZE/2+5,y-TILESIZE/2,TILESIZE-10,TILESIZE)
+        self.camera.reset(self.map.bounds, self.player.rect.center)
+        self.initial = self.snapshot()
+        self.restore(dict(self.initial, player=now['player'], alive=now['alive'], shots=now['shots'],
+                          camera=now['camera'], map=now['map'], ticks=now['ticks']))
+        self.camera.reset(self.map.bounds, self.camera.rect.center)
+
+    def won(self):
+        return bool(self.player_group)
+
+    def savePositions(self):
+        self.player.savePosition()
+        for spr in self.map.active:
+            spr.savePosition()
+
+    def update(self,inp):
+        player = self.player
+        self.savePositions()
+        #Once done the world keeps running underneath the fade out
+        if not self.done():
+            if inp[K_ESCAPE]:
+                self.quit = True
+                self.player_group.empty()
+            if inp[K_r]:
+                self.player_group.empty()
+            if inp[K_s]:
+                for bubble in self.text_group:
+                    bubble.next_msg()
+        PROFILER.lap('input')
+        self.map.update()
+        PROFILER.lap('map update')
+        if not self.done():
+            player.update(inp)
+            self.text_group.update(player.rect.x+50,player.rect.y-60)
+            if self.map.grid.collideMask(player,[self.map.enemies]):
+                player.sawkill()
+        PROFILER.lap('saws')
+        self.camera.follow(player.rect.center)
+        self.map.stream(self.camera.rect)
+        SCHEDULER.update()
+        self.ticks += 1
+        SIMCLOCK.advance()
+
+    def draw(self,alpha=1.0):
+        SIMCLOCK.alpha = alpha
+        if self.camera.interpolate(alpha):
+            DIRTY.markAll()
+        self.map.draw()
+        if self.player_group or self.player.dying:
+            self.player.updateArm()
+            self.player.shots.draw()
+            self.player.draw()
+        PROFILER.lap('player draw')
+        for bubble in self.text_group:
+            bubble.draw()
+        PROFILER.lap('speech bubbles')
+        drawFade(self.fade)
+
+class LevelPrefetcher(object):
+    def __init__(self):
+        self.pending = {}
+        self.timings = []
+
+    def __str__(self):
+        return "Reads and compiles upcoming levels on worker threads."
+
+    def build(self, n, slot):
+        #Only file work happens here. Surfaces, fonts and the ASSETS caches
+        #are not thread safe, so the Level itself is built in get()
+        start = time.time()
+        try:
+            slot['text'] = loadCompiledLevel(n)
+        except Exception:
+            slot['error'] = sys.exc_info()
+        slot['fetch'] = time.time() - start
+
+    def request(self, n):
+        if n in self.pending:
+            return
+        slot = {}
+        thread = threading.Thread(target=self.build, args=(n, slot))
+        thread.daemon = True
+        self.pending[n] = (thread, slot)
+        thread.start()
+
+    def get(self, n):
+        self.request(n)
+        thread, slot = self.pending.pop(n)
+        start = time.time()
+        thread.join()
+        if 'error' in slot:
+            exc = slot['error']
+            raise exc[0], exc[1], exc[2]
+        maptxt, enemytxt = slot['text']
+        level = Level(n, maptxt, enemytxt)
+        self.timings.append((n, slot['fetch'], time.time() - start))
+        return level
+
+    def lastTiming(self):
+        if not self.timings:
+            return None
+        return self.timings[-1]
+
+PREFETCH = LevelPrefetcher()
+
+class LevelWatcher(object):
+    def __init__(self, interval=WATCH_INTERVAL):
+        self.interval = interval
+        self.last = time.time()
+        self.mtimes = self.scan()
+
+    def __str__(self):
+        return "Polls the level sources for edits."
+
+    def scan(self):
+        mtimes = {}
+        for folder in ('map', 'map/enemies'):
+            for name in os.listdir(folder):
+                if name.endswith('.txt'):
+                    path = os.path.join(folder, name)
+                    try:
+                        mtimes[path] = os.path.getmtime(path)
+                    except OSError:
+                        pass
+        return mtimes
+
+    def poll(self):
+        #Names of the levels whose sources changed since the last look
+        now = time.time()
+        if now - self.last < self.interval:
+            return set()
+        self.last = now
+        mtimes = self.scan()
+        paths = set(mtimes) | set(self.mtimes)
+        self.mtimes, old = mtimes, self.mtimes
+        return set([os.path.basename(p)[:-4] for p in paths if mtimes.get(p) != old.get(p)])
+
+WATCHER = None
+if WATCH_LEVELS:
+    WATCHER = LevelWatcher()
+
+def nextLevel(n):
+    #Named levels are played on their own, then the game starts over
+    if not isinstance(n, int) or n >= NUMBEROFLEVELS:
+        return 1
+    return n + 1
+
+def initHeadless():
+    global HEADLESS, BASICFONT, SMALLFONT
+    HEADLESS = True
+    pygame.font.init()
+    ASSETS.openPack()
+    BASICFONT = ASSETS.font('monospace', 30, True)
+    SMALLFONT = ASSETS.font('monospace', 14, True)
+
+def simulateLevel(n,inputs,maxticks=None):
+    #Steps a level as fast as possible from a stream of InputStates
+    level = Level(n)
+    level.start()
+    for inp in inputs:
+        if level.done() or (maxticks is not None and level.ticks >= maxticks):
+            break
+        level.update(inp)
+    return level
+
+def runLevel(n,level=None):
+    global GAMESTATE
+    if level is None:
+        level = Level(n)
+    PREFETCH.request(nextLevel(n))
+    level.start()
+    DIRTY.markAll()
+    step = 1000.0/FPS
+    accumulator = step
+    skipped = 0
+    fading = None
+    recorder = None
+    if INPUT_LOG:
+        if not os.path.isdir(INPUT_LOG):
+            os.makedirs(INPUT_LOG)
+        recorder = InputRecorder(os.path.join(INPUT_LOG, '%s-%d.inp' % (n, time.time())))
+    FPSCLOCK.tick()
+    while fading is None or SCHEDULER.running(fading):
+        if fading is None and level.done():
+            if level.quit:
+                break
+            if not level.won():
+                #Deaths and R rewind in place instead of rebuilding the level
+                level.restart()
+            else:
+                fading = SCHEDULER.spawn(fadeOut(level))
+        if WATCHER is not None and str(n) in WATCHER.poll():
+            try:
+                level.reload(*loadCompiledLevel(n))
+            except (LevelError, IOError), e:
+                #Editors save half-written files; the next save fixes it
+                sys.stderr.write('reload failed: %s\n' % e)
+        PROFILER.begin()
+        for event in INPUT.pump():
+            if event.type == QUIT:
+                terminate()
+            if event.type == KEYDOWN and event.key == PROFILE_HOTKEY:
+                PROFILER.toggleOverlay()
+        steps = 0
+        while accumulator >= step and steps < MAX_CATCHUP:
+            inp = INPUT.snapshot()
+            PROFILER.count('input lag', INPUT.lag)
+            if recorder is not None:
+                recorder.write(inp)
+            level.update(inp)
+            accumulator -= step
+            steps += 1
+        if accumulator >= step:
+            #Too far behind to catch up; let the game slow down instead
+            accumulator = 0.0
+        if steps > 1 and skipped < MAX_FRAMESKIP:
+            skipped += 1
+        else:
+            skipped = 0
+            level.draw(accumulator/step)
+            PROFILER.draw()
+            PROFILER.lap('overlay')
+            updateDisplay()
+            PROFILER.lap('display flip')
+        PROFILER.end()
+        accumulator += FPSCLOCK.tick(RENDER_FPS)
+
+    if recorder is not None:
+        recorder.close()
+    INPUT.reset()
+    if level.quit:
+        GAMESTATE = MENU
+    return level.won()
+
 ####################
 ####    MENU THINGS
 ####################
 class Button(object):
     def __init__(self, text, (x,y), xlen, ylen, fontsize):
-        self.fontObj = pygame.font.Font('freesansbold.ttf', fontsize)
+        self.fontObj = ASSETS.font('freesansbold.ttf', fontsize)
         self.text = self.fontObj.render(text, True, (255,255,255))
         self.rect = self.text.get_rect()
         self.rect.center = (x,y)
@@ -658,74 +2761,74 @@ class Menu(object):
         global BASICFONT
         self.text = BASICFONT.render("press 's' to start", True, (255,255,255))
         
-        self.image = pygame.image.load('img/menu_bg.png')
-        self.img_cloud1 = pygame.image.load('img/menu_cloud1.png')
-        self.img_cloud2 = pygame.image.load('img/menu_cloud2.png')
-        self.img_cloud3 = pygame.image.load('img/menu_cloud3.png')
-
-        self.image.set_colorkey((255,255,255))
-        self.img_cloud1.set_colorkey((255,255,255))
-        self.img_cloud2.set_colorkey((255,255,255))
-        self.img_cloud3.set_colorkey((255,255,255))
+        self.background = ASSETS.parallax(MENU_LAYERS)
 
         self.x = 800
         
         self.yes = 0
+        self.fade = 0
 
     def update(self):
-        DISPLAYSURF.blit(self.image, (0,0))
-        '''DISPLAYSURF.blit(self.img_cloud1, (800-self.x,0))
-        DISPLAYSURF.blit(self.img_cloud1, (0-self.x,0))
-        for i in range(3):
-            DISPLAYSURF.blit(self.img_cloud2, (i*800-self.x*2,0))'''
-        for i in range(6):
-            DISPLAYSURF.blit(self.img_cloud3, (i*800-self.x*4,0))
+        self.background.draw(self.x)
 
         self.x -= 1
         if self.x < 0:
             self.x = 800
+        DIRTY.mark(self.text.get_rect(topleft=(300,350)))
 
         if self.yes <= 10:
             DISPLAYSURF.blit(self.text, (300,350))
         elif self.yes > 20:
             self.yes = 0
         self.yes += 1
+        drawFade(self.fade)
 
 
-def main():
-    global FPSCLOCK, DISPLAYSURF, BASICFONT, SMALLFONT, GAMESTATE
+def initDisplay():
+    global FPSCLOCK, DISPLAYSURF, BASICFONT, SMALLFONT
     pygame.init()
     pygame.font.init()
-    pygame.mixer.init()
-    BASICFONT = pygame.font.SysFont('monospace', 30)
-    SMALLFONT = pygame.font.SysFont('monospace', 14)
+    BASICFONT = ASSETS.font('monospace', 30, True)
+    SMALLFONT = ASSETS.font('monospace', 14, True)
     DISPLAYSURF = pygame.display.set_mode((WINDOWWIDTH,WINDOWHEIGHT))
     FPSCLOCK = pygame.time.Clock()
+    ASSETS.openPack()
+
+def main():
+    global GAMESTATE
+    initDisplay()
+    pygame.mixer.init()
     menu = Menu()
     GAMESTATE = MENU
-    currentlevel = 15
-    pygame.mixer.music.load('sound/funkycruise.wav')
-    pygame.mixer.music.play(-1)    
+    currentlevel = START_LEVEL
+    fading = None
+    PREFETCH.request(currentlevel)
+    AUDIO.init()
+    AUDIO.music()    
     while True:
         if GAMESTATE == MENU:
             #DISPLAYSURF.fill((0,25,100))
             menu.update()
-            pygame.display.update()
+            updateDisplay()
             FPSCLOCK.tick(FPS)
-            for event in pygame.event.get():
+            SCHEDULER.update()
+            for event in INPUT.pump():
                 if event.type == QUIT:
                     terminate()
-                if pygame.key.get_pressed()[K_ESCAPE]:
-                    terminate()
-                if pygame.key.get_pressed()[K_s]:
-                    GAMESTATE = PLAY
+            inp = INPUT.snapshot()
+            if inp[K_ESCAPE]:
+                terminate()
+            if inp[K_s] and fading is None:
+                fading = SCHEDULER.spawn(fadeOut(menu))
+            if fading is not None and not SCHEDULER.running(fading):
+                fading = None
+                menu.fade = 0
+                GAMESTATE = PLAY
         if GAMESTATE == PLAY:
-            fadeToBlack()
-            if runLevel(currentlevel):
-                currentlevel += 1
-            if currentlevel>NUMBEROFLEVELS:
-                fadeToBlack()
-                currentlevel = 1
+            PREFETCH.request(currentlevel)
+            if runLevel(currentlevel, PREFETCH.get(currentlevel)):
+                currentlevel = nextLevel(currentlevel)
+            DIRTY.markAll()
 
 if __name__ == '__main__':
     main()